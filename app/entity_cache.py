@@ -0,0 +1,106 @@
+"""
+ Size bounded cache of entity documents that sits in front of db.entities lookups by id
+ Entries are evicted least recently used first and expire after a fixed time,
+ if a redis connection is given it is used as a second tier that is shared by all processes,
+ and every local hit is checked against the entity's version in redis, so writes and invalidations by any process
+ are seen by all of them straight away
+"""
+
+import json
+import uuid
+import threading
+import time
+from collections import OrderedDict
+
+class EntityCache(object):
+    # fields that are never cached, tokens are private and _id can't be serialized for redis
+    excluded_fields = ('_id', 'tokens')
+
+    def __init__(self, max_size, ttl, redis_client=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.redis_client = redis_client
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, entity_id, loader=None):
+        """ returns a copy of the cached entity, on a miss loader(entity_id) is used to find and cache it """
+        with self._lock:
+            entry = self._entries.get(entity_id)
+            if entry is not None and entry[1] <= time.time():
+                del self._entries[entity_id]
+                entry = None
+
+        if entry is not None and self.redis_client is not None:
+            # another process may have written or invalidated the entity since it was cached here
+            if self.redis_client.get(self.version_key(entity_id)) != entry[2]:
+                with self._lock:
+                    self._entries.pop(entity_id, None)
+                entry = None
+        if entry is not None:
+            with self._lock:
+                if entity_id in self._entries:
+                    self._entries.move_to_end(entity_id)
+                self.hits += 1
+            return dict(entry[0])
+
+        if self.redis_client is not None:
+            cached_json, version = self.redis_client.mget([self.redis_key(entity_id), self.version_key(entity_id)])
+            if cached_json is not None and version is not None:
+                entity_doc = json.loads(cached_json.decode('utf-8'))
+                self._store_local(entity_id, entity_doc, version)
+                with self._lock:
+                    self.hits += 1
+                return dict(entity_doc)
+
+        with self._lock:
+            self.misses += 1
+        if loader is None:
+            return None
+        entity_doc = loader(entity_id)
+        if entity_doc is None:
+            return None
+        self.set(entity_id, entity_doc)
+        return self._cacheable_fields(entity_doc)
+
+    def set(self, entity_id, entity_doc):
+        """ caches an entity document, replacing any older version of it """
+        entity_doc = self._cacheable_fields(entity_doc)
+        version = None
+        if self.redis_client is not None:
+            version = uuid.uuid4().hex.encode('utf-8')
+            pipe = self.redis_client.pipeline()
+            pipe.setex(self.redis_key(entity_id), self.ttl, json.dumps(entity_doc))
+            pipe.setex(self.version_key(entity_id), self.ttl, version)
+            pipe.execute()
+        self._store_local(entity_id, entity_doc, version)
+
+    def invalidate(self, entity_id):
+        """ removes an entity from the cache so the next lookup goes to the database """
+        with self._lock:
+            self._entries.pop(entity_id, None)
+        if self.redis_client is not None:
+            self.redis_client.delete(self.redis_key(entity_id), self.version_key(entity_id))
+
+    def stats(self):
+        """ returns the hit and miss counters of this process, along with the current size of the local tier """
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'size': len(self._entries)}
+
+    def redis_key(self, entity_id):
+        return 'entity_cache:' + str(entity_id)
+
+    def version_key(self, entity_id):
+        return 'entity_cache_version:' + str(entity_id)
+
+    def _cacheable_fields(self, entity_doc):
+        return {key: value for key, value in entity_doc.items() if key not in self.excluded_fields}
+
+    def _store_local(self, entity_id, entity_doc, version=None):
+        with self._lock:
+            self._entries[entity_id] = (entity_doc, time.time() + self.ttl, version)
+            self._entries.move_to_end(entity_id)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
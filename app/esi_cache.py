@@ -0,0 +1,96 @@
+"""
+ Response cache for the ESI clients, EsiClient already only caches responses until their 'Expires' header
+ Responses are kept in a size bounded in-memory tier, and optionally in redis so they are shared by all processes
+"""
+
+from esipy.cache import BaseCache
+
+import hashlib
+import pickle
+import re
+import threading
+import time
+from collections import OrderedDict
+from urllib.parse import urlsplit
+
+class EsiCache(BaseCache):
+    def __init__(self, max_size, redis_client=None):
+        self.max_size = max_size
+        self.redis_client = redis_client
+        self.operation_stats = {}
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        """ returns the cached response for an EsiClient cache key, or default if there isn't an unexpired one """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if entry[1] > time.time():
+                    self._entries.move_to_end(key)
+                    self._count(key, 'hits')
+                    return entry[0]
+                del self._entries[key]
+
+        if self.redis_client is not None:
+            redis_key = self.redis_key(key)
+            cached_value, ttl = self._redis_get(redis_key)
+            if cached_value is not None and ttl > 0:
+                value = pickle.loads(cached_value)
+                self._store_local(key, value, ttl)
+                with self._lock:
+                    self._count(key, 'hits')
+                return value
+
+        with self._lock:
+            self._count(key, 'misses')
+        return default
+
+    def set(self, key, value, timeout=300):
+        """ caches a response, EsiClient sets timeout to the number of seconds until the response expires """
+        self._store_local(key, value, timeout)
+        if self.redis_client is not None:
+            self.redis_client.setex(self.redis_key(key), timeout, pickle.dumps(value))
+
+    def invalidate(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+        if self.redis_client is not None:
+            self.redis_client.delete(self.redis_key(key))
+
+    def stats(self):
+        """ returns the hit/miss counters and hit rate of every ESI operation seen by this process """
+        with self._lock:
+            stats = {}
+            for operation, counters in self.operation_stats.items():
+                stats[operation] = dict(counters)
+                stats[operation]['hit_rate'] = counters['hits'] / (counters['hits'] + counters['misses'])
+            return stats
+
+    def redis_key(self, key):
+        """
+        EsiClient keys contain frozensets, which don't iterate in the same order in every process,
+        so they are sorted before hashing to get a key that all processes agree on
+        """
+        url, headers, path, query = key
+        canonical_key = (url, sorted(headers), sorted(path), sorted(query, key=str))
+        return 'esi_cache:' + hashlib.md5(repr(canonical_key).encode('utf-8')).hexdigest()
+
+    def _redis_get(self, redis_key):
+        pipe = self.redis_client.pipeline()
+        pipe.get(redis_key)
+        pipe.ttl(redis_key)
+        return pipe.execute()
+
+    def _store_local(self, key, value, timeout):
+        with self._lock:
+            self._entries[key] = (value, time.time() + timeout)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def _count(self, key, counter):
+        # ids are replaced so that all requests for the same operation share their counters
+        operation = re.sub(r'/\d+', '/{id}', urlsplit(key[0]).path)
+        counters = self.operation_stats.setdefault(operation, {'hits': 0, 'misses': 0})
+        counters[counter] += 1
@@ -0,0 +1,140 @@
+"""
+ Rate limiter for ESI requests that is shared by every process through redis
+ Requests take a token from a cluster wide token bucket, and slow down as ESI's error limit budget
+ (the 'X-ESI-Error-Limit-Remain' and 'X-ESI-Error-Limit-Reset' headers) runs low, so parallel workers can't get the IP banned
+ EsiClients use it through LimitedHTTPAdapter, which is mounted as their transport adapter and also holds their connection pool
+"""
+
+from requests.adapters import HTTPAdapter
+
+import time
+
+# takes one token from the bucket, returns how long the caller has to wait for it as a string
+# the bucket can go negative, which reserves tokens for callers that are already waiting
+token_bucket_script = """
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local now = tonumber(ARGV[3])
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'updated')
+local tokens = tonumber(bucket[1]) or burst
+local updated = tonumber(bucket[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - updated) * rate)
+local wait = 0
+if tokens < 1 then
+    wait = (1 - tokens) / rate
+end
+redis.call('HMSET', KEYS[1], 'tokens', tokens - 1, 'updated', now)
+redis.call('EXPIRE', KEYS[1], math.ceil(burst / rate) + 60)
+return tostring(wait)
+"""
+
+class EsiLimiter(object):
+    bucket_key = 'esi_limiter:bucket'
+    error_budget_key = 'esi_limiter:error_budget'
+    metrics_key = 'esi_limiter:metrics'
+
+    def __init__(self, redis_client, rate, burst, error_budget_low, error_budget_min):
+        self.redis_client = redis_client
+        self.rate = rate
+        self.burst = burst
+        self.error_budget_low = error_budget_low
+        self.error_budget_min = error_budget_min
+        self._take_token = redis_client.register_script(token_bucket_script)
+
+    def acquire(self):
+        """ blocks until the calling process is allowed to send a request to ESI """
+        wait = float(self._take_token(keys=[self.bucket_key], args=[self.rate, self.burst, time.time()]).decode('utf-8'))
+        wait += self.error_budget_wait()
+        pipe = self.redis_client.pipeline()
+        pipe.hincrby(self.metrics_key, 'requests', 1)
+        if wait > 0:
+            pipe.hincrby(self.metrics_key, 'throttled_requests', 1)
+            pipe.hincrbyfloat(self.metrics_key, 'wait_seconds', wait)
+        pipe.execute()
+        if wait > 0:
+            time.sleep(wait)
+
+    def error_budget_wait(self):
+        """
+        returns how long to hold a request back because of the error budget, nothing while it's above error_budget_low,
+        then the rest of the reset window is spread over the remaining budget, and at error_budget_min requests wait for the reset
+        """
+        pipe = self.redis_client.pipeline()
+        pipe.get(self.error_budget_key)
+        pipe.ttl(self.error_budget_key)
+        remain, reset = pipe.execute()
+        if remain is None or reset is None or reset < 0:
+            return 0
+        remain = int(remain)
+        if remain <= self.error_budget_min:
+            return reset
+        if remain < self.error_budget_low:
+            return reset / (remain - self.error_budget_min)
+        return 0
+
+    def record(self, response, new_connections=0):
+        """
+        stores the error budget that ESI sent with a response, it expires when ESI resets the budget
+        new_connections is the number of connections opened to send the request, for the connection reuse counters
+        """
+        pipe = self.redis_client.pipeline()
+        if new_connections > 0:
+            pipe.hincrby(self.metrics_key, 'new_connections', new_connections)
+        else:
+            pipe.hincrby(self.metrics_key, 'reused_connections', 1)
+        if response.status_code >= 400:
+            pipe.hincrby(self.metrics_key, 'errors', 1)
+        if 'X-ESI-Error-Limit-Remain' in response.headers and 'X-ESI-Error-Limit-Reset' in response.headers:
+            remain = int(response.headers['X-ESI-Error-Limit-Remain'])
+            reset = max(int(response.headers['X-ESI-Error-Limit-Reset']), 1)
+            pipe.setex(self.error_budget_key, reset, remain)
+        pipe.execute()
+
+    def stats(self):
+        """ returns the current error budget and the request, wait and connection counters of all processes """
+        pipe = self.redis_client.pipeline()
+        pipe.get(self.error_budget_key)
+        pipe.ttl(self.error_budget_key)
+        pipe.hgetall(self.metrics_key)
+        remain, reset, metrics = pipe.execute()
+        stats = {key.decode('utf-8'): float(value) for key, value in metrics.items()}
+        stats['error_limit_remain'] = int(remain) if remain is not None else None
+        stats['error_limit_reset'] = reset if remain is not None else None
+        return stats
+
+class LimitedHTTPAdapter(HTTPAdapter):
+    """
+    transport adapter for EsiClient that passes every request through an EsiLimiter,
+    requests without their own timeout use the adapter's (connect, read) timeout
+    GET requests that get one of retry_statuses are retried here rather than by urllib3, so every attempt
+    takes a token from the limiter and has its error counted against the error budget
+    """
+    retry_statuses = (502, 503, 504)
+
+    def __init__(self, limiter, timeout=None, status_retries=0, retry_backoff=0, *args, **kwargs):
+        self.limiter = limiter
+        self.timeout = timeout
+        self.status_retries = status_retries
+        self.retry_backoff = retry_backoff
+        super().__init__(*args, **kwargs)
+
+    def send(self, request, **kwargs):
+        if kwargs.get('timeout') is None:
+            kwargs['timeout'] = self.timeout
+        attempt = 0
+        while True:
+            self.limiter.acquire()
+            connections_before = self.opened_connections()
+            response = super().send(request, **kwargs)
+            self.limiter.record(response, self.opened_connections() - connections_before)
+            if (response.status_code not in self.retry_statuses or request.method != 'GET' or
+                    attempt >= self.status_retries):
+                return response
+            response.close()
+            time.sleep(self.retry_backoff * (2 ** attempt))
+            attempt += 1
+
+    def opened_connections(self):
+        """ returns the number of connections the pools of this adapter have opened, requests that don't add one reused a connection """
+        pools = [self.poolmanager.pools.get(pool_key) for pool_key in list(self.poolmanager.pools.keys())]
+        return sum(pool.num_connections for pool in pools if pool is not None)
@@ -12,8 +12,13 @@ from flask_login import LoginManager
 from flask_rq2 import RQ
 
 import redis
+from urllib3.util.retry import Retry
 
 import config
+from app.entity_cache import EntityCache
+from app.esi_cache import EsiCache
+from app.esi_limiter import EsiLimiter
+from app.esi_limiter import LimitedHTTPAdapter
 
 # define mongo global for other modules
 mongo = PyMongo()
@@ -22,29 +27,89 @@ mongo = PyMongo()
 login_manager = LoginManager()
 login_manager.login_view = 'login'
 
+# direct access to redis is needed for some components, like statistics caching
+r = redis.StrictRedis(host=config.REDIS_URL, port=config.REDIS_PORT, db=0)
+
+# rendered journal tables are cached until the journal version of an entity they list changes
+# jobs bump the version of every entity with a page that they write journal entries for, and all_journals_version on every write
+# versions expire after JOURNAL_VERSION_TTL, a missing version is read as '0'
+all_journals_version = 'all'
+
+def journal_version_key(version_id):
+    return 'journal_version:' + str(version_id)
+
 # Initialize ESI connection, all three below globals are needed to set up ESI connection
 esiapp = App.create(config.ESI_SWAGGER_JSON)
 
+# all clients share one response cache, so public data fetched by any thread (or any process with redis) is reused
+esi_cache = EsiCache(config.ESI_CACHE_SIZE, redis_client=r if config.ESI_CACHE_USE_REDIS else None)
+
+# all clients in all processes share one request rate and ESI error budget
+esi_limiter = EsiLimiter(r, config.ESI_RATE_LIMIT, config.ESI_RATE_BURST,
+                         config.ESI_ERROR_BUDGET_LOW, config.ESI_ERROR_BUDGET_MIN)
+
+def create_esisecurity():
+    """ creates a new security object, jobs that run in threads need one each as it holds the current token """
+    return EsiSecurity(
+        app=esiapp,
+        redirect_uri=config.ESI_CALLBACK,
+        client_id=config.ESI_CLIENT_ID,
+        secret_key=config.ESI_SECRET_KEY,
+        headers={'User-Agent': config.ESI_USER_AGENT}
+    )
+
+def create_esiclient(security, cache=esi_cache):
+    """
+    creates a new client, authed calls made with it use the token held by the given security object
+    all clients of a process share esi_transport_adapter, so its kept alive connections outlive the threads that used them
+    """
+    return EsiClient(
+        security=security,
+        cache=cache,
+        headers={'User-Agent': config.ESI_USER_AGENT},
+        transport_adapter=esi_transport_adapter
+    )
+
+def create_transport_adapter():
+    """
+    creates the pooled, keep-alive transport for the ESI clients, failed connections are retried with backoff by urllib3
+    and 502-504s by the adapter itself, so those go through the limiter
+    """
+    retries = Retry(
+        total=config.ESI_RETRIES,
+        backoff_factor=config.ESI_RETRY_BACKOFF,
+        # urllib3 would otherwise retry 503s with a Retry-After header by itself
+        respect_retry_after_header=False
+    )
+    return LimitedHTTPAdapter(
+        esi_limiter,
+        timeout=(config.ESI_CONNECT_TIMEOUT, config.ESI_READ_TIMEOUT),
+        status_retries=config.ESI_RETRIES,
+        retry_backoff=config.ESI_RETRY_BACKOFF,
+        pool_connections=config.ESI_POOL_CONNECTIONS,
+        pool_maxsize=config.ESI_POOL_MAXSIZE,
+        max_retries=retries
+    )
+
+# one connection pool per process, urllib3 pools are thread safe so every client and thread can share it
+# rq forks a work horse for each job, so connections are only reused within a job unless workers don't fork (SimpleWorker)
+esi_transport_adapter = create_transport_adapter()
+
 # init the security object
-esisecurity = EsiSecurity(
-    app=esiapp,
-    redirect_uri=config.ESI_CALLBACK,
-    client_id=config.ESI_CLIENT_ID,
-    secret_key=config.ESI_SECRET_KEY,
-    headers={'User-Agent': config.ESI_USER_AGENT}
-)
+esisecurity = create_esisecurity()
 
 # init the client
-esiclient = EsiClient(
-    security=esisecurity,
-    cache=None,
-    headers={'User-Agent': config.ESI_USER_AGENT}
-)
+esiclient = create_esiclient(esisecurity)
+
+# EsiClient cache keys don't include the request body, so bulk POSTs like /universe/names/ and /characters/affiliation/
+# would be answered with the cached response of an earlier request for different ids, they use this client instead
+uncached_esiclient = create_esiclient(esisecurity, cache=None)
 
 # init RQ, result_ttl needs to be unset so that scheduled jobs will always continue to run
 rq = RQ()
 rq.default_result_ttl = None
 rq.default_timeout = config.DEFAULT_TIMEOUT
 
-# direct access to redis is needed for some components, like statistics caching
-r = redis.StrictRedis(host=config.REDIS_URL, port=config.REDIS_PORT, db=0)
+# entity lookups by id are cached for both flask and background workers, optionally backed by redis
+entity_cache = EntityCache(config.ENTITY_CACHE_SIZE, config.ENTITY_CACHE_TTL,
+                           redis_client=r if config.ENTITY_CACHE_USE_REDIS else None)
@@ -12,6 +12,8 @@ from flask import abort
 from flask import request
 from flask import jsonify
 from flask import Blueprint
+from flask import current_app
+from flask import Markup
 
 from flask_login import current_user
 from flask_login import login_required
@@ -19,7 +21,13 @@ from flask_login import login_required
 import config
 from app.flask_shared_modules import mongo
 from app.flask_shared_modules import r
+from app.flask_shared_modules import entity_cache
+from app.flask_shared_modules import journal_version_key
+from app.flask_shared_modules import all_journals_version
+from app.search_index import search_grams
+from app.search_index import normalize
 
+import hashlib
 import re
 from collections import OrderedDict
 from datetime import datetime
@@ -27,37 +35,26 @@ from datetime import timezone
 
 main_pages = Blueprint('main_pages', __name__)
 
+# fields of journal entries that are only used for querying, they are left out so they don't show in the details modal
+journal_projection = {'_id': False, 'parties': False, 'party_flows': False, 'alliance_ids': False}
+
+# key orders of journal rows by their set of keys, see sorted_keys()
+key_order_cache = {}
+KEY_ORDER_CACHE_SIZE = 1000
+
+# the party_flows direction that each journal tab shows
+tx_directions = {'gains': 'gain', 'losses': 'loss', 'neutral': 'neutral'}
+
 @main_pages.route('/')
-@main_pages.route('/<int:page_number>')
-def index(page_number=1, *args):
+def index(*args):
     """ paginated main index page, contains latest journal entries and 'top' statistics """
-    # ensure page is in valid range
-    page_range_check(page_number)
-    
-    # find all transactions in database
-    journal_cursor = mongo.db.journals.find({})
-    
-    # calculate number of entries to skip in database
-    skip_amount = (page_number - 1) * config.PAGE_SIZE
-    
-    # sort (required for ordered transactions), skip over entries based on our page number,
-    # then limit the number of results returned
-    journal_cursor.sort('id', -1).skip(skip_amount).limit(config.PAGE_SIZE)
-    
-    # initialize empty journal_entries to ensure something gets passed to render_template
-    journal_entries = []
-    for entry in journal_cursor:
+    def adjust_entry(entry):
         # if this corp wasn't the receiver of tax, then it had to pay out the tax
         if 'tax' in entry:
             entry['tax'] = entry['tax'] * -1
-            
-        # turn common line items in journal entry into proper names and generated URLs
-        process_common_fields(entry)
-        
-        # sort the journal entry by name so line items are less random in transaction details modal
-        sorted_entry = OrderedDict(sorted(entry.items(), key=lambda x: x[0]))
-        
-        journal_entries.append(sorted_entry)
+    
+    # find and render the requested page of all transactions in database, every journal write changes this page
+    journal_html = render_journal_entries([all_journals_version], {}, adjust_entry)
         
     # for the index page, the cached 'top' statistics are retrieved and decoded from redis
     top_character_bytes = r.hgetall('top_character_wallet')
@@ -70,26 +67,24 @@ def index(page_number=1, *args):
         
     top_tx_bytes = r.hgetall('top_tx_day')
     top_tx = redis_bytes_to_data(top_tx_bytes)
-    top_tx = mongo.db.journals.find_one({'id': top_tx.get('id') or 0})
+    top_tx = mongo.db.journals.find_one({'id': top_tx.get('id') or 0}, journal_projection)
     if top_tx:
         process_common_fields(top_tx)
         top_tx = OrderedDict(sorted(top_tx.items(), key=lambda x: x[0]))
     else:
         top_tx = {}
     
-    return render_template('index.html', journal_entries=journal_entries, page_number=page_number,
+    return render_template('index.html', journal_html=journal_html,
                            top_character=top_character, top_corp=top_corp, top_tx=top_tx)
 
 @main_pages.route('/character/<int:entity_id>')
-@main_pages.route('/character/<int:entity_id>/<int:page_number>')
 @main_pages.route('/character/<int:entity_id>/<tx_type>')
-@main_pages.route('/character/<int:entity_id>/<tx_type>/<int:page_number>')
-def character(entity_id, page_number=1, tx_type='all'):
+def character(entity_id, tx_type='all'):
     """ paginated character page, has character details and journal entries """
-    # ensure page is in valid range
-    page_range_check(page_number)
-    
     request.view_args['tx_type'] = tx_type
+    # old '/<entity_id>/<page_number>' links also land here, they would otherwise list every journal entry
+    if tx_type != 'all' and tx_type not in tx_directions:
+        abort(404)
     
     # find user in database, or return a 404
     character_filter = {'id': entity_id}
@@ -101,44 +96,25 @@ def character(entity_id, page_number=1, tx_type='all'):
     conditional_decode(character_data, 'corporation_')
     conditional_decode(character_data, 'alliance_')
     
-    # find all journal entries that this entity is involved in
-    journal_search = make_entity_filter(entity_id, tx_type)
-    journal_cursor = mongo.db.journals.find(journal_search)
-    
-    # calculate number of entries to skip in database
-    skip_amount = (page_number - 1) * config.PAGE_SIZE
-    
-    # sort (required for ordered transactions), skip over entries based on our page number,
-    # then limit the number of results returned
-    journal_cursor.sort('id', -1).skip(skip_amount).limit(config.PAGE_SIZE)
-    
-    # initialize empty journal_entries to ensure something gets passed to render_template
-    journal_entries = []
-    for entry in journal_cursor:
+    def adjust_entry(entry):
         # since this is a character, it pays tax not gains it
         if 'tax_receiver_id' in entry:
             entry['tax'] = entry['tax'] * -1
-            
-        # turn common line items in journal entry into proper names and generated URLs
-        process_common_fields(entry)
-        
-        # sort the journal entry by name so line items are less random in transaction details modal
-        sorted_entry = OrderedDict(sorted(entry.items(), key=lambda x: x[0]))
-        
-        journal_entries.append(sorted_entry)
+    
+    # find and render all journal entries that this entity is involved in
+    journal_search = make_entity_filter(entity_id, tx_type)
+    journal_html = render_journal_entries([entity_id], journal_search, adjust_entry, character_data)
         
-    return render_template('character.html', entity_data=character_data, journal_entries=journal_entries, page_number=page_number)
+    return render_template('character.html', entity_data=character_data, journal_html=journal_html)
 
 @main_pages.route('/corporation/<int:entity_id>')
-@main_pages.route('/corporation/<int:entity_id>/<int:page_number>')
 @main_pages.route('/corporation/<int:entity_id>/<tx_type>')
-@main_pages.route('/corporation/<int:entity_id>/<tx_type>/<int:page_number>')
-def corporation(entity_id, page_number=1, tx_type='all'):
+def corporation(entity_id, tx_type='all'):
     """ paginated corporation page, has corp details and journal entries """
-    # ensure page is in valid range
-    page_range_check(page_number)
-    
     request.view_args['tx_type'] = tx_type
+    # old '/<entity_id>/<page_number>' links also land here, they would otherwise list every journal entry
+    if tx_type != 'all' and tx_type not in tx_directions:
+        abort(404)
     
     # find user in database, or return a 404
     corp_filter = {'id': entity_id}
@@ -155,44 +131,25 @@ def corporation(entity_id, page_number=1, tx_type='all'):
         for wallet in (corp_data['wallets'] or None):
             corp_data['wallets_total'] += wallet['balance']
     
-    # find all journal entries that this entity is involved in
-    journal_search = make_entity_filter(entity_id, tx_type)
-    journal_cursor = mongo.db.journals.find(journal_search)
-    
-    # calculate number of entries to skip in database
-    skip_amount = (page_number - 1) * config.PAGE_SIZE
-    
-    # sort (required for ordered transactions), skip over entries based on our page number,
-    # then limit the number of results returned
-    journal_cursor.sort('id', -1).skip(skip_amount).limit(config.PAGE_SIZE)
-    
-    # initialize empty journal_entries to ensure something gets passed to render_template
-    journal_entries = []
-    for entry in journal_cursor:
+    def adjust_entry(entry):
         # if this corp wasn't the receiver of tax, then it had to pay out the tax
         if 'tax' in entry and entry['tax_receiver_id'] != entity_id:
             entry['tax'] = entry['tax'] * -1
-            
-        # turn common line items in journal entry into proper names and generated URLs
-        process_common_fields(entry)
-        
-        # sort the journal entry by name so line items are less random in transaction details modal
-        sorted_entry = OrderedDict(sorted(entry.items(), key=lambda x: x[0]))
-        
-        journal_entries.append(sorted_entry)
+    
+    # find and render all journal entries that this entity is involved in
+    journal_search = make_entity_filter(entity_id, tx_type)
+    journal_html = render_journal_entries([entity_id], journal_search, adjust_entry, corp_data)
         
-    return render_template('corporation.html', entity_data=corp_data, journal_entries=journal_entries, page_number=page_number)
+    return render_template('corporation.html', entity_data=corp_data, journal_html=journal_html)
 
 @main_pages.route('/alliance/<int:entity_id>')
-@main_pages.route('/alliance/<int:entity_id>/<int:page_number>')
 @main_pages.route('/alliance/<int:entity_id>/<tx_type>')
-@main_pages.route('/alliance/<int:entity_id>/<tx_type>/<int:page_number>')
-def alliance(entity_id, page_number=1, tx_type='all'):
+def alliance(entity_id, tx_type='all'):
     """ paginated alliance page, has alliance details and journal entries from all corps """
-    # ensure page is in valid range
-    page_range_check(page_number)
-    
     request.view_args['tx_type'] = tx_type
+    # old '/<entity_id>/<page_number>' links also land here, they would otherwise list every journal entry
+    if tx_type != 'all' and tx_type not in tx_directions:
+        abort(404)
     
     # find user in database, or return a 404
     alliance_filter = {'id': entity_id}
@@ -208,31 +165,19 @@ def alliance(entity_id, page_number=1, tx_type='all'):
     conditional_decode(alliance_data, 'executor_corporation_')
     
     # find all journal entries that this entity's corps are involved in
-    journal_search = make_entity_filter({ '$in': alliance_data['corps'] }, tx_type)
-    journal_cursor = mongo.db.journals.find(journal_search)
-    
-    # calculate number of entries to skip in database
-    skip_amount = (page_number - 1) * config.PAGE_SIZE
-    
-    # sort (required for ordered transactions), skip over entries based on our page number,
-    # then limit the number of results returned
-    journal_cursor.sort('id', -1).skip(skip_amount).limit(config.PAGE_SIZE)
-    
-    # initialize empty journal_entries to ensure something gets passed to render_template
-    journal_entries = []
-    for entry in journal_cursor:
-        if 'tax' in entry and entry['tax_receiver_id'] not in alliance_data['corps']:
+    # entries are stamped with the alliances of their corps, in alliance_ids and party_flows, so no tab needs to look for every corp
+    if tx_type == 'all':
+        journal_search = {'alliance_ids': entity_id}
+    else:
+        journal_search = make_entity_filter(entity_id, tx_type)
+    alliance_corps = set(alliance_data['corps'])
+    def adjust_entry(entry):
+        if 'tax' in entry and entry['tax_receiver_id'] not in alliance_corps:
             entry['tax'] = entry['tax'] * -1
-            
-        # turn common line items in journal entry into proper names and generated URLs
-        process_common_fields(entry)
-        
-        # sort the journal entry by name so line items are less random in transaction details modal
-        sorted_entry = OrderedDict(sorted(entry.items(), key=lambda x: x[0]))
-        
-        journal_entries.append(sorted_entry)
+    
+    journal_html = render_journal_entries([entity_id], journal_search, adjust_entry, alliance_data)
         
-    return render_template('alliance.html', entity_data=alliance_data, journal_entries=journal_entries, page_number=page_number)
+    return render_template('alliance.html', entity_data=alliance_data, journal_html=journal_html)
 
 @main_pages.route('/faq')
 def faq():
@@ -243,8 +188,7 @@ def faq():
 # they all use context_id_routes() to do most of the work
 ####################
 @main_pages.route('/system/<int:entity_id>')
-@main_pages.route('/system/<int:entity_id>/<int:page_number>')
-def system(entity_id, page_number=1):
+def system(entity_id):
     """ page for systems, the stations in the system must be retrieved so those transactions are also displayed """
     id_filter = {'id': entity_id}
     entity_data = mongo.db.entities.find_one_or_404(id_filter)
@@ -253,82 +197,67 @@ def system(entity_id, page_number=1):
     find_ids = [entity_id]
     if 'stations' in entity_data:
         find_ids.extend(entity_data['stations'])
-    return context_id_routes({ '$in': find_ids }, 'system', page_number, entity_data)
+    return context_id_routes({ '$in': find_ids }, 'system', entity_data)
 
 @main_pages.route('/constellation/<int:entity_id>')
-@main_pages.route('/constellation/<int:entity_id>/<int:page_number>')
-def constellation(entity_id, page_number=1):
+def constellation(entity_id):
     """ page for constellations, the systems and the stations in those system must be retrieved so those transactions are also displayed """
     id_filter = {'id': entity_id}
     entity_data = mongo.db.entities.find_one_or_404(id_filter)
     if entity_data['type'] != 'constellation':
         abort(404)
-    find_ids = entity_data['systems']
-    for system in entity_data['systems']:
-        id_filter = {'id': system}
-        system_data = mongo.db.entities.find_one(id_filter)
-        if system_data:
-            if 'stations' in system_data:
-                find_ids.extend(system_data['stations'])
-    return context_id_routes({ '$in': find_ids }, 'constellation', page_number, entity_data)
+    find_ids = find_system_and_station_ids({'type': 'system', 'constellation_id': entity_id})
+    return context_id_routes({ '$in': find_ids }, 'constellation', entity_data)
 
 @main_pages.route('/region/<int:entity_id>')
-@main_pages.route('/region/<int:entity_id>/<int:page_number>')
-def region(entity_id, page_number=1):
-    """ page for regions, the constellations, systems, and the stations in those system must be retrieved so those transactions are also displayed """
+def region(entity_id):
+    """ page for regions, the systems and the stations in those system must be retrieved so those transactions are also displayed """
     id_filter = {'id': entity_id}
     entity_data = mongo.db.entities.find_one_or_404(id_filter)
     if entity_data['type'] != 'region':
         abort(404)
-    system_ids = []
-    for constellation in entity_data['constellations']:
-        id_filter = {'id': constellation}
-        constellation_data = mongo.db.entities.find_one(id_filter)
-        if constellation_data:
-            system_ids.extend(constellation_data['systems'])
-            for system in constellation_data['systems']:
-                id_filter = {'id': system}
-                system_data = mongo.db.entities.find_one(id_filter)
-                if system_data:
-                    if 'stations' in system_data:
-                        system_ids.extend(system_data['stations'])
-    return context_id_routes({ '$in': system_ids }, 'region', page_number, entity_data)
+    find_ids = find_system_and_station_ids({'type': 'system', 'region_id': entity_id})
+    return context_id_routes({ '$in': find_ids }, 'region', entity_data)
 
 @main_pages.route('/ship/<int:entity_id>')
-@main_pages.route('/ship/<int:entity_id>/<int:page_number>')
-def ship(entity_id, page_number=1):
-    return context_id_routes(entity_id, 'ship', page_number)
+def ship(entity_id):
+    return context_id_routes(entity_id, 'ship')
 
 @main_pages.route('/item/<int:entity_id>')
-@main_pages.route('/item/<int:entity_id>/<int:page_number>')
-def item(entity_id, page_number=1):
-    return context_id_routes(entity_id, 'item', page_number)
+def item(entity_id):
+    return context_id_routes(entity_id, 'item')
 
 @main_pages.route('/station/<int:entity_id>')
-@main_pages.route('/station/<int:entity_id>/<int:page_number>')
-def station(entity_id, page_number=1):
-    return context_id_routes(entity_id, 'station', page_number)
+def station(entity_id):
+    return context_id_routes(entity_id, 'station')
 
 @main_pages.route('/group/<int:entity_id>')
-@main_pages.route('/group/<int:entity_id>/<int:page_number>')
-def group(entity_id, page_number=1):
+def group(entity_id):
     """ page for item groups, the items that are in said group must be retrieved so those transactions are also displayed """
     id_filter = {'id': entity_id}
     entity_data = mongo.db.entities.find_one_or_404(id_filter)
     if entity_data['type'] != 'group':
         abort(404)
-    return context_id_routes({ '$in': entity_data['types'] }, 'group', page_number, entity_data)
+    return context_id_routes({ '$in': entity_data['types'] }, 'group', entity_data)
 
-def context_id_routes(entity_id, context_type, page_number, entity_group_data=None):
+def find_system_and_station_ids(system_filter):
+    """
+    returns the ids of the systems matching system_filter and of the stations in them, with a single query
+    systems are stored with their constellation_id and region_id, so the constellations don't need to be read first
+    """
+    find_ids = []
+    for system_data in mongo.db.entities.find(system_filter, {'id': True, 'stations': True}):
+        find_ids.append(system_data['id'])
+        find_ids.extend(system_data.get('stations', []))
+    return find_ids
+
+def context_id_routes(entity_id, context_type, entity_group_data=None):
     """
     does most of the work to create the context pages.
     If the entity data has already been retrieved because this context has children,
     entity_group_data is set so we don't have to hit the DB again
     this also means that entity_id will actually be an $in query, not really an ID
     """
-    # ensure page is in valid range
-    page_range_check(page_number)
-    
     # find user in database, or return a 404
     if not entity_group_data:
         id_filter = {'id': entity_id}
@@ -341,51 +270,65 @@ def context_id_routes(entity_id, context_type, page_number, entity_group_data=No
     conditional_decode(entity_data, 'group_')
     conditional_decode(entity_data, 'system_')
     
-    # find all journal entries that this entity's corps are involved in
+    # find and render all journal entries that this entity is in the context of
     journal_search = {'context.id': entity_id}
-    journal_cursor = mongo.db.journals.find(journal_search)
-    
-    # calculate number of entries to skip in database
-    skip_amount = (page_number - 1) * config.PAGE_SIZE
-    
-    # sort (required for ordered transactions), skip over entries based on our page number,
-    # then limit the number of results returned
-    journal_cursor.sort('id', -1).skip(skip_amount).limit(config.PAGE_SIZE)
-    
-    # initialize empty journal_entries to ensure something gets passed to render_template
-    journal_entries = []
-    for entry in journal_cursor:
-        # turn common line items in journal entry into proper names and generated URLs
-        process_common_fields(entry)
-        
-        # sort the journal entry by name so line items are less random in transaction details modal
-        sorted_entry = OrderedDict(sorted(entry.items(), key=lambda x: x[0]))
-        
-        journal_entries.append(sorted_entry)
+    if isinstance(entity_id, dict):
+        version_ids = entity_id['$in']
+    else:
+        version_ids = [entity_id]
+    journal_html = render_journal_entries(version_ids, journal_search, None, entity_data)
         
-    return render_template(str(context_type) + '.html', entity_data=entity_data, journal_entries=journal_entries, page_number=page_number)
+    return render_template(str(context_type) + '.html', entity_data=entity_data, journal_html=journal_html)
 
 # End context routes
 
-@main_pages.route('/search', methods=['POST'])
+@main_pages.route('/search', methods=['GET', 'POST'])
 def search():
     """
-    handler for search operations
-    NOTE: this type of search is BAD for performance, but it should be ok for now
-    eventually alternative options will have to be explored (like ElasticSearch)
+    handler for search operations, GET requests (?q=) can be cached by browsers and proxies for SEARCH_CACHE_TTL seconds
+    results are also cached in redis by the normalized search string, so each distinct search hits the DB once per SEARCH_CACHE_TTL
     """
     # search_string should always be present if a user properly performed a search from the searchbar
-    if 'search_string' not in request.form:
+    if request.method == 'GET':
+        search_string = request.args.get('q')
+    else:
+        search_string = request.form.get('search_string')
+    if search_string is None:
         abort(400)
-        
+    search_string = normalize(search_string)
+    
+    cache_key = 'search:' + search_string
+    cached_results = r.get(cache_key)
+    if cached_results is not None:
+        response = current_app.response_class(cached_results, mimetype='application/json')
+    else:
+        response = jsonify(find_search_results(search_string))
+        r.setex(cache_key, config.SEARCH_CACHE_TTL, response.get_data())
+    
+    if request.method == 'GET':
+        response.cache_control.public = True
+        response.cache_control.max_age = config.SEARCH_CACHE_TTL
+    # return results to searchbar, the rest is handled by javascript
+    return response
+
+def find_search_results(search_string):
+    """
+    returns the first 10 entities whose name contains search_string
+    entities are first narrowed down to the ones containing every n-gram of the search string with the search_grams index,
+    the regex then only has to check those candidates
+    """
+    grams = search_grams(search_string)
+    if len(grams) == 0:
+        return []
+    
     # the string the user is searching for must be sanitized so special regex characters aren't misinterpreted
-    sanitized_string = '^(.*?)(' + re.escape(request.form['search_string']) + ')(.*)'
+    sanitized_string = '^(.*?)(' + re.escape(search_string) + ')(.*)'
     python_regex = re.compile(sanitized_string, re.IGNORECASE)
     bson_regex = bson.regex.Regex.from_native(python_regex)
-    regex_find = {'name': bson_regex}
+    regex_find = {'name': bson_regex, 'search_grams': {'$all': grams}}
     
-    # here is where the actual search is performed, THIS REQUIRES A FULL DB SCAN
-    results = mongo.db.entities.find(regex_find)
+    # here is where the actual search is performed
+    results = mongo.db.entities.find(regex_find, {'id': True, 'name': True, 'type': True})
     
     # only the first 10 results are returned to prevent overwhelming the end user
     # a result has the format of [id, html formatted name with bolded matched text, type, image_url]
@@ -402,8 +345,7 @@ def search():
         else:
             one_result.append(make_img_url(result['type'], result['id']))
         limited_results.append(one_result)
-    # return results to searchbar, the rest is handled by javascript
-    return jsonify(limited_results)
+    return limited_results
 
 @main_pages.route('/account')
 @login_required
@@ -428,11 +370,98 @@ def account():
     character_data['scopes'] = scopes_list
     return render_template('account.html', user=character_data)
 
-def page_range_check(page_number):
-    """ returns a 404 if the page is outside the supported number of pages """
-    # TODO: change these to config values and ensure that value is passed to paginated.html
-    if page_number > 10 or page_number < 1:
-        abort(404)
+def render_journal_entries(version_ids, journal_search, adjust_entry=None, entity_data=None):
+    """
+    returns the rendered journal table for a page, with entries found by journal_search and changed by adjust_entry(entry)
+    the table doesn't depend on the logged in user, so it is cached in redis by url for every visitor,
+    refresh jobs bump the journal version of each entity they write entries for (see shared.bump_journal_versions()),
+    which changes the cache key of every page listing one of version_ids
+    """
+    versions = r.mget([journal_version_key(version_id) for version_id in version_ids]) if version_ids else []
+    version_hash = hashlib.md5(b':'.join(version or b'0' for version in versions)).hexdigest()
+    cache_key = 'page_cache:' + request.full_path + ':' + version_hash
+    cached_html = r.get(cache_key)
+    if cached_html is not None:
+        return Markup(cached_html.decode('utf-8'))
+    
+    journal_page, pagination = find_journal_page(journal_search)
+    journal_entries = process_journal_rows(journal_page, adjust_entry)
+    
+    template_args = {'journal_entries': journal_entries, 'pagination': pagination}
+    if entity_data is not None:
+        template_args['entity_data'] = entity_data
+    journal_html = render_template('journal_entries.html', **template_args)
+    r.setex(cache_key, config.PAGE_CACHE_TTL, journal_html)
+    return Markup(journal_html)
+
+def process_journal_rows(journal_page, adjust_entry=None):
+    """
+    turns journal documents into the rows shown by journal_entries.html, changing each with adjust_entry(entry) first
+    links are only built once for each entity on the page, as the same entities show up in most rows
+    """
+    link_cache = {}
+    journal_entries = []
+    for entry in journal_page:
+        if adjust_entry:
+            adjust_entry(entry)
+            
+        # turn common line items in journal entry into proper names and generated URLs
+        process_common_fields(entry, link_cache)
+        
+        # sort the journal entry by name so line items are less random in transaction details modal
+        journal_entries.append(OrderedDict((key, entry[key]) for key in sorted_keys(entry)))
+    return journal_entries
+
+def sorted_keys(entry):
+    """ returns the keys of a journal row in name order, rows of the same ref_type share their keys so the order is only sorted once """
+    entry_keys = frozenset(entry)
+    key_order = key_order_cache.get(entry_keys)
+    if key_order is None:
+        key_order = tuple(sorted(entry_keys))
+        if len(key_order_cache) < KEY_ORDER_CACHE_SIZE:
+            key_order_cache[entry_keys] = key_order
+    return key_order
+
+def find_journal_page(journal_search):
+    """
+    returns a cursor for one page of journal entries matching journal_search, newest first, along with the pagination links
+    pages are seeked by journal id instead of skipped over, ?before=<id> gives the entries older than that id
+    and ?after=<id> the ones newer than it, so any page costs the same as the first one
+    """
+    before = request.args.get('before', type=int)
+    after = request.args.get('after', type=int)
+    if after is not None:
+        # newer entries are found oldest first so the limit keeps the ones right after the seek id
+        journal_cursor = mongo.db.journals.find(add_id_bound(journal_search, {'$gt': after}), journal_projection)
+        journal_entries = list(journal_cursor.sort('id', 1).limit(config.PAGE_SIZE + 1))
+        has_newer = len(journal_entries) > config.PAGE_SIZE
+        journal_entries = journal_entries[:config.PAGE_SIZE]
+        journal_entries.reverse()
+        has_older = True
+    else:
+        if before is not None:
+            journal_search = add_id_bound(journal_search, {'$lt': before})
+        journal_cursor = mongo.db.journals.find(journal_search, journal_projection)
+        journal_entries = list(journal_cursor.sort('id', -1).limit(config.PAGE_SIZE + 1))
+        has_older = len(journal_entries) > config.PAGE_SIZE
+        journal_entries = journal_entries[:config.PAGE_SIZE]
+        has_newer = before is not None
+    
+    pagination = {'newer': None, 'older': None, 'is_first': before is None and after is None}
+    if len(journal_entries) > 0:
+        if has_newer:
+            pagination['newer'] = journal_entries[0]['id']
+        if has_older:
+            pagination['older'] = journal_entries[-1]['id']
+    return journal_entries, pagination
+    
+def add_id_bound(journal_search, id_bound):
+    """ adds a range on the journal id to a query, it goes inside each $or branch so every branch can seek its own index """
+    if '$or' in journal_search:
+        bounded_search = dict(journal_search)
+        bounded_search['$or'] = [dict(branch, id=id_bound) for branch in journal_search['$or']]
+        return bounded_search
+    return dict(journal_search, id=id_bound)
         
 def conditional_decode(entry, id_prefix):
     """ helper to decode normalized entity database ids to names and urls """
@@ -440,12 +469,15 @@ def conditional_decode(entry, id_prefix):
         if entry[id_prefix + 'id'] == 2:
             entry[id_prefix + 'id'] = 'Corporation'
             return
-        id_filter = {'id': entry[id_prefix + 'id']}
-        result = mongo.db.entities.find_one(id_filter)
+        result = entity_cache.get(entry[id_prefix + 'id'], find_entity)
         if result is not None:
             entry[id_prefix + 'name'] = result['name']
             entry[id_prefix + 'url'] = url_for('.' + result['type'], entity_id=result['id'])
             
+def find_entity(entity_id):
+    """ loader for the entity cache when an entity isn't cached yet """
+    return mongo.db.entities.find_one({'id': entity_id})
+
 def make_img_url(entry_type, entry_id):
     """ helper to create image urls that come from the EVE images server """
     if entry_type == 'character':
@@ -461,17 +493,15 @@ def make_img_url(entry_type, entry_id):
     else:
         return ''
 
-def context_decode(entry):
+def context_decode(entry, link_cache):
     """ special helper for context entries to add img and page urls, able to handle all types of contexts """
     if 'context' in entry:
         for context_entry in entry['context']:
             if 'name' in context_entry:
                 # 'type_id' being in the context entry means this is a station, and therefore needs to use a different id for the image
-                if 'type_id' in context_entry:
-                    context_entry['img'] = make_img_url(context_entry['type'], context_entry['type_id'])
-                else:
-                    context_entry['img'] = make_img_url(context_entry['type'], context_entry['id'])
-                context_entry['url'] = url_for('.' + context_entry['type'], entity_id=context_entry['id'])
+                img_id = context_entry.get('type_id', context_entry['id'])
+                context_entry['img'], context_entry['url'] = entity_links(context_entry['type'], context_entry['id'],
+                                                                          img_id, link_cache)
 
 def redis_bytes_to_data(redis_object):
     """ helper function to turn the raw bytes returned from redis into their proper values """
@@ -488,63 +518,46 @@ def redis_bytes_to_data(redis_object):
 def make_entity_filter(entity_filter, tx_type):
     """
     returns the actual query used for searching for journal entries
-    note that context.id is included here, as sometimes characters and others show up in context.id
-    for example when a bounty is received, but this means that entity didn't actually gain/lose isk
+    note that context ids are included in 'parties' and are neutral in 'party_flows', as sometimes characters and others
+    show up in context.id, for example when a bounty is received, but this means that entity didn't actually gain/lose isk
     """
     journal_search = {}
     if tx_type == 'all':
-        journal_search = {'$or':[ 
-            {'first_party_id': entity_filter},
-            {'second_party_id': entity_filter},
-            {'first_party_corp_id': entity_filter},
-            {'second_party_corp_id': entity_filter},
-            {'tax_receiver_id': entity_filter},
-            {'context.id': entity_filter}
-        ]}
-    elif tx_type == 'gains':
-        journal_search = {'$or':[ 
-            {'$and': [{'first_party_id': entity_filter}, {'first_party_amount': {'$gt': 0}}]},
-            {'$and': [{'second_party_id': entity_filter}, {'second_party_amount': {'$gt': 0}}]},
-            {'$and': [{'first_party_corp_id': entity_filter}, {'first_party_amount': {'$gt': 0}}]},
-            {'$and': [{'second_party_corp_id': entity_filter}, {'second_party_amount': {'$gt': 0}}]},
-            {'tax_receiver_id': entity_filter}
-        ]}
-    elif tx_type == 'losses':
-        journal_search = {'$or':[ 
-            {'$and': [{'first_party_id': entity_filter}, {'first_party_amount': {'$lt': 0}}]},
-            {'$and': [{'second_party_id': entity_filter}, {'second_party_amount': {'$lt': 0}}]},
-            {'$and': [{'first_party_corp_id': entity_filter}, {'first_party_amount': {'$lt': 0}}]},
-            {'$and': [{'second_party_corp_id': entity_filter}, {'second_party_amount': {'$lt': 0}}]},
-        ]}
-    elif tx_type == 'neutral':
-        journal_search = {'$or':[ 
-            {'$and': [{'first_party_id': entity_filter}, {'first_party_amount': {'$eq': 0}}]},
-            {'$and': [{'second_party_id': entity_filter}, {'second_party_amount': {'$eq': 0}}]},
-            {'$and': [{'first_party_corp_id': entity_filter}, {'first_party_amount': {'$eq': 0}}]},
-            {'$and': [{'second_party_corp_id': entity_filter}, {'second_party_amount': {'$eq': 0}}]},
-            {'context.id': entity_filter}
-        ]}
+        # 'parties' holds every party id and context id of an entry, so this is a single index scan
+        journal_search = {'parties': entity_filter}
+    elif tx_type in tx_directions:
+        # 'party_flows' records which way isk moved for each party, so the tabs are a single index scan like 'all'
+        journal_search = {'party_flows': {'$elemMatch': {'id': entity_filter, 'dir': tx_directions[tx_type]}}}
     return journal_search
 
-def process_common_fields(entry):
-    """ helper to process fields that are common across journal entries """
+def process_common_fields(entry, link_cache=None):
+    """
+    helper to process fields that are common across journal entries
+    link_cache can be shared by the entries of a page so each entity's links are only built once
+    """
+    if link_cache is None:
+        link_cache = {}
     entry['date'] = datetime.fromtimestamp(entry['date'], timezone.utc).strftime("%Y-%m-%d %X")
-    party_decode(entry, 'tax_receiver_')
-    party_decode(entry, 'first_party_')
-    party_decode(entry, 'second_party_')
-    party_decode(entry, 'first_party_corp_')
-    party_decode(entry, 'second_party_corp_')
-    context_decode(entry)
-    
-def party_decode(entry, id_prefix):
+    party_decode(entry, 'tax_receiver_', link_cache)
+    party_decode(entry, 'first_party_', link_cache)
+    party_decode(entry, 'second_party_', link_cache)
+    party_decode(entry, 'first_party_corp_', link_cache)
+    party_decode(entry, 'second_party_corp_', link_cache)
+    context_decode(entry, link_cache)
+    
+def party_decode(entry, id_prefix, link_cache):
     """ helper to decode entity database ids to image and page urls"""
     if (id_prefix + 'id') in entry:
         if entry[id_prefix + 'id'] == 2:
             entry[id_prefix + 'id'] = 'Corporation'
         elif (id_prefix + 'name') in entry:
-            if (id_prefix + 'type') in entry:
-                entry[id_prefix + 'img'] = make_img_url(entry[id_prefix + 'type'], entry[id_prefix + 'id'])
-                entry[id_prefix + 'url'] = url_for('.' + entry[id_prefix + 'type'], entity_id=entry[id_prefix + 'id'])
-            else:
-                entry[id_prefix + 'img'] = make_img_url('corporation', entry[id_prefix + 'id'])
-                entry[id_prefix + 'url'] = url_for('.corporation', entity_id=entry[id_prefix + 'id'])
\ No newline at end of file
+            entry_type = entry.get(id_prefix + 'type', 'corporation')
+            entry[id_prefix + 'img'], entry[id_prefix + 'url'] = entity_links(entry_type, entry[id_prefix + 'id'],
+                                                                              entry[id_prefix + 'id'], link_cache)
+                
+def entity_links(entry_type, entry_id, img_id, link_cache):
+    """ returns the (image url, page url) of an entity, from link_cache if they were already built for this page """
+    link_key = (entry_type, entry_id, img_id)
+    if link_key not in link_cache:
+        link_cache[link_key] = (make_img_url(entry_type, img_id), url_for('.' + entry_type, entity_id=entry_id))
+    return link_cache[link_key]
\ No newline at end of file
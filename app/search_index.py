@@ -0,0 +1,28 @@
+"""
+ Helpers for the entity name search index
+ Entities store the 2 and 3 character n-grams of their lowercased name in 'search_grams', which has a multikey index,
+ so a search only has to look at entities that contain every n-gram of the search string
+"""
+
+def normalize(text):
+    return ' '.join(text.lower().split())
+
+def name_grams(name):
+    """ returns the n-grams that are stored for an entity name """
+    normalized_name = normalize(name)
+    grams = set()
+    for gram_size in (2, 3):
+        for start in range(len(normalized_name) - gram_size + 1):
+            grams.add(normalized_name[start:start + gram_size])
+    return sorted(grams)
+
+def search_grams(search_string):
+    """
+    returns the n-grams that an entity name must contain to match search_string, the longest ones are used as they are the rarest
+    returns an empty list if the search string is too short to use the index
+    """
+    normalized_string = normalize(search_string)
+    gram_size = min(len(normalized_string), 3)
+    if gram_size < 2:
+        return []
+    return sorted(set(normalized_string[start:start + gram_size] for start in range(len(normalized_string) - gram_size + 1)))
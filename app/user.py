@@ -5,6 +5,8 @@ from pymongo import ReturnDocument
 
 from flask_login.mixins import UserMixin
 
+from app.search_index import name_grams
+
 from datetime import datetime
 
 class User(UserMixin):
@@ -20,6 +22,7 @@ class User(UserMixin):
             data_to_update['type'] = 'character'
             data_to_update['id'] = character_data['CharacterID']
             data_to_update['name'] = character_data['CharacterName']
+            data_to_update['search_grams'] = name_grams(data_to_update['name'])
             character_filter = {'id': character_data['CharacterID']}
             data_to_update['tokens'] = auth_response
             data_to_update['tokens']['ExpiresOn'] = character_data['ExpiresOn']
@@ -0,0 +1,93 @@
+"""
+ Benchmark of the journal row processing done by the listing routes, compares the per-field pipeline that
+ routes used before (full documents, url_for for every link, a sort per row) with routes.process_journal_rows()
+ it needs the same environment as the site, as importing the routes sets up the shared modules
+ run with: python -m benchmarks.journal_rows [number of pages]
+"""
+
+from flask import Flask
+from flask import url_for
+
+import config
+from app import routes
+
+import copy
+import random
+import sys
+import timeit
+from collections import OrderedDict
+from datetime import datetime
+from datetime import timezone
+
+def make_page(page_size):
+    """ returns a page of journal documents shaped like the stored ones, shared between a few parties like a real page """
+    characters = [90000000 + character for character in range(5)]
+    corps = [98000000 + corp for corp in range(3)]
+    journal_page = []
+    for entry_id in range(page_size):
+        first_party_id = random.choice(characters)
+        second_party_id = random.choice(corps)
+        entry = {
+            'id': 16000000000 + entry_id,
+            'date': 1530000000.0 + entry_id,
+            'ref_type': 'market_transaction',
+            'description': 'Market transaction',
+            'first_party_id': first_party_id,
+            'first_party_name': 'Character ' + str(first_party_id),
+            'first_party_type': 'character',
+            'first_party_amount': -1000000.0,
+            'first_party_balance': 5000000000.0,
+            'second_party_id': second_party_id,
+            'second_party_name': 'Corp ' + str(second_party_id),
+            'second_party_type': 'corporation',
+            'second_party_amount': 1000000.0,
+            'tax': 10000.0,
+            'tax_receiver_id': second_party_id,
+            'tax_receiver_name': 'Corp ' + str(second_party_id),
+            'context': [
+                {'id': 60003760, 'type': 'station', 'type_id': 52678, 'name': 'Jita IV - Moon 4 - Caldari Navy Assembly Plant'},
+                {'id': 34, 'type': 'item', 'name': 'Tritanium'}
+            ],
+            'parties': [first_party_id, second_party_id, 60003760, 34],
+            'party_flows': [{'id': first_party_id, 'dir': 'loss'}, {'id': second_party_id, 'dir': 'gain'}],
+            'alliance_ids': [99000000]
+        }
+        journal_page.append(entry)
+    return journal_page
+
+def legacy_process_rows(journal_page):
+    """ the row processing the routes did before process_journal_rows() """
+    journal_entries = []
+    for entry in journal_page:
+        entry['date'] = datetime.fromtimestamp(entry['date'], timezone.utc).strftime("%Y-%m-%d %X")
+        for id_prefix in ('tax_receiver_', 'first_party_', 'second_party_', 'first_party_corp_', 'second_party_corp_'):
+            if (id_prefix + 'id') in entry and (id_prefix + 'name') in entry:
+                entry_type = entry.get(id_prefix + 'type', 'corporation')
+                entry[id_prefix + 'img'] = routes.make_img_url(entry_type, entry[id_prefix + 'id'])
+                entry[id_prefix + 'url'] = url_for('main_pages.' + entry_type, entity_id=entry[id_prefix + 'id'])
+        for context_entry in entry['context']:
+            context_entry['img'] = routes.make_img_url(context_entry['type'], context_entry.get('type_id', context_entry['id']))
+            context_entry['url'] = url_for('main_pages.' + context_entry['type'], entity_id=context_entry['id'])
+        journal_entries.append(OrderedDict(sorted(entry.items(), key=lambda x: x[0])))
+    return journal_entries
+
+def lean_process_rows(journal_page):
+    """ the current row processing, documents come from the DB without the fields left out by journal_projection """
+    for entry in journal_page:
+        for field in routes.journal_projection:
+            entry.pop(field, None)
+    return routes.process_journal_rows(journal_page)
+
+def main():
+    pages = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    app = Flask(__name__)
+    app.register_blueprint(routes.main_pages)
+    journal_page = make_page(config.PAGE_SIZE)
+    with app.test_request_context('/'):
+        for name, process_rows in (('legacy', legacy_process_rows), ('lean', lean_process_rows)):
+            seconds = timeit.timeit(lambda: process_rows(copy.deepcopy(journal_page)), number=pages)
+            copy_seconds = timeit.timeit(lambda: copy.deepcopy(journal_page), number=pages)
+            print(name + ': ' + '%.3f' % ((seconds - copy_seconds) / pages * 1000) + ' ms per page of ' + str(config.PAGE_SIZE) + ' rows')
+
+if __name__ == '__main__':
+    main()
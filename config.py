@@ -9,6 +9,9 @@ SECRET_KEY = 'REPLACE ME'
 PORT = 5015
 HOST = 'localhost'
 PAGE_SIZE = 25
+SEARCH_CACHE_TTL = 60  # seconds that search results are cached by redis, browsers and proxies
+PAGE_CACHE_TTL = 300  # most seconds a rendered journal table is cached, new journal entries replace it sooner
+JOURNAL_VERSION_TTL = 2 * PAGE_CACHE_TTL  # seconds a journal version outlives its last change, must be above PAGE_CACHE_TTL
 
 # -----------------------------------------------------
 # MongoDB Configs
@@ -27,6 +30,21 @@ ESI_SECRET_KEY = 'REPLACE ME'  # your secret key
 ESI_CLIENT_ID = 'REPLACE ME'  # your client ID
 ESI_CALLBACK = 'http://%s:%d/sso/callback' % (HOST, PORT)  # the callback URI you gave CCP
 ESI_USER_AGENT = 'HowPoorRU by Demogorgon Asmodeous'
+ESI_CACHE_SIZE = 10000  # number of responses kept in memory by each process
+ESI_CACHE_USE_REDIS = True  # share cached responses between all processes, they still expire with ESI's 'Expires' header
+ESI_RATE_LIMIT = 20  # requests per second to ESI, shared by all processes
+ESI_RATE_BURST = 40  # requests that can be sent at once after a quiet period
+# requests are spread out once ESI's error limit budget drops below ESI_ERROR_BUDGET_LOW,
+# and held until the budget resets once it reaches ESI_ERROR_BUDGET_MIN
+ESI_ERROR_BUDGET_LOW = 50
+ESI_ERROR_BUDGET_MIN = 10
+# connection pool shared by all ESI clients of a process, connections are kept alive and reused between requests
+ESI_POOL_CONNECTIONS = 4  # number of hosts a pool is kept for
+ESI_POOL_MAXSIZE = 32  # connections kept per host, enough for WALLET_REFRESH_WORKERS * JOURNAL_PAGE_WORKERS threads
+ESI_RETRIES = 3
+ESI_RETRY_BACKOFF = 0.5  # seconds, doubled after each retry
+ESI_CONNECT_TIMEOUT = 5
+ESI_READ_TIMEOUT = 30
 
 # ------------------------------------------------------
 # Session settings for flask login
@@ -39,9 +57,57 @@ PERMANENT_SESSION_LIFETIME = datetime.timedelta(days=30)
 JOB_LOG_LEVEL = logging.INFO
 RQ_SCHEDULER_INTERVAL = 10
 DEFAULT_TIMEOUT = 1800
+# tokens are refreshed in the background once they expire within TOKEN_REFRESH_AHEAD seconds,
+# the refresh job runs every TOKEN_REFRESH_INTERVAL seconds with TOKEN_REFRESH_WORKERS concurrent SSO requests
+TOKEN_REFRESH_AHEAD = 300
+TOKEN_REFRESH_INTERVAL = 60
+TOKEN_REFRESH_WORKERS = 4
+# seconds that an id which isn't a character/corp/alliance is skipped before ESI is asked about it again
+UNRESOLVABLE_ID_TTL = 86400
+# seconds that the etags of wallet and journal responses are kept for conditional requests
+ETAG_TTL = 604800
+# number of characters, corps and alliances refreshed by each run of the public info refresh, stalest first
+PUBLIC_REFRESH_BATCH_SIZE = 2000
+# number of documents updated per bulk write by the backfill jobs in jobs/migrations.py
+MIGRATION_BATCH_SIZE = 1000
+
+# -----------------------------------------------------
+# Static Data Configs (see jobs/static_data_import.py)
+# -----------------------------------------------------
+STATIC_DATA_PATH = 'static_data'  # directory holding the universe JSON files written by jobs/static_data_convert.py
+STATIC_DATA_BATCH_SIZE = 1000
+# set to False once the static data has been imported so context decoding never asks ESI for static data
+STATIC_DATA_ESI_FALLBACK = True
+# number of characters (or corps) processed in parallel by the wallet refresh jobs, 1 processes them serially
+WALLET_REFRESH_WORKERS = 8
+# how often the poll scheduler looks for characters and corps that are due for a wallet refresh
+POLL_DISPATCH_INTERVAL = 30
+POLL_BATCH_SIZE = 500  # most entities processed per dispatch
+# entities are polled again after POLL_IDLE_FACTOR * the time since their last journal entry, within these bounds (seconds)
+POLL_IDLE_FACTOR = 0.05
+POLL_MIN_INTERVAL = 120
+POLL_MAX_INTERVAL = 3600
+# queue a separate rq job for each due entity so refreshes scale with the number of rq workers,
+# when False the dispatcher refreshes them itself with WALLET_REFRESH_WORKERS threads
+# rq runs each job in a freshly forked work horse, so with fan out ESI connections are only reused within one entity's
+# refresh and the limiter's connection counters will mostly show new connections, unless the workers run SimpleWorker
+WALLET_REFRESH_FAN_OUT = True
+# number of journal pages requested at the same time when an entity has multiple pages of new entries
+JOURNAL_PAGE_WORKERS = 4
+# maximum number of journal entries sent to MongoDB in a single bulk write
+JOURNAL_WRITE_BATCH_SIZE = 500
 
 # -----------------------------------------------------
 # Redis Configs
 # -----------------------------------------------------
 REDIS_URL = 'localhost'
 REDIS_PORT = 6379
+
+# -----------------------------------------------------
+# Entity Cache Configs
+# -----------------------------------------------------
+ENTITY_CACHE_SIZE = 20000
+ENTITY_CACHE_TTL = 600  # seconds before a cached entity is looked up in the DB again
+# share cached entities between all web and job processes, entity writes by jobs are then seen by the site straight away
+# without redis each process only sees its own writes, other processes can serve an entity up to ENTITY_CACHE_TTL seconds old
+ENTITY_CACHE_USE_REDIS = False
@@ -7,15 +7,78 @@ from pymongo import ReturnDocument
 
 from jobs import shared
 from jobs.shared import logger
+from app.search_index import name_grams
 
-def decode_context_id(journal_entry, entity_doc, division):
+import config
+
+class TransactionIndex(object):
+    """
+    market transactions of a character or corp division indexed by transaction_id, so every market
+    journal entry in a refresh is resolved from the same few requests instead of one request each
+    """
+    def __init__(self, entity_doc, division=None):
+        self.entity_doc = entity_doc
+        self.division = division
+        self.transactions = {}
+        # (oldest, newest) transaction_id ranges that ESI has already returned
+        self.fetched_ranges = []
+        # once ESI fails, the remaining lookups are left for the next refresh instead of failing again one by one
+        self.failed = False
+        
+    def get(self, transaction_id):
+        """ returns the transaction, only asking ESI for it if it is outside every range fetched so far """
+        if transaction_id not in self.transactions and not self.is_fetched(transaction_id):
+            if len(self.fetched_ranges) == 0 and not self.failed:
+                # the first request gets the most recent transactions, which is where new journal entries will be
+                self.fetch()
+            if not self.is_fetched(transaction_id) and not self.failed:
+                self.fetch(transaction_id)
+        return self.transactions.get(transaction_id)
+    
+    def is_fetched(self, transaction_id):
+        for oldest, newest in self.fetched_ranges:
+            if oldest <= transaction_id <= newest:
+                return True
+        return False
+    
+    def fetch(self, from_id=None):
+        """ adds transactions to the index, from_id gets that transaction and the ones before it """
+        from_param = {'from_id': from_id} if from_id else {}
+        if not self.division:
+            op = shared.esiapp.op['get_characters_character_id_wallet_transactions'](
+                character_id=self.entity_doc['id'],
+                **from_param
+            )
+        else:
+            op = shared.esiapp.op['get_corporations_corporation_id_wallets_division_transactions'](
+                corporation_id=self.entity_doc['id'],
+                division=self.division,
+                **from_param
+            )
+        # transactions are private data, so the client holding the token for this thread's entity must be used
+        public_data = shared.get_worker_esi()[1].request(op)
+        if public_data.status != 200:
+            logger.error('status: ' + str(public_data.status) + ' error with getting market transactions: ' + str(public_data.data))
+            logger.error('headers: ' + str(public_data.header))
+            logger.error('entity with error: ' + str(self.entity_doc['id']))
+            self.failed = True
+            return
+        transaction_ids = []
+        for transaction in public_data.data:
+            self.transactions[transaction['transaction_id']] = transaction
+            transaction_ids.append(transaction['transaction_id'])
+        if len(transaction_ids) > 0:
+            self.fetched_ranges.append((min(transaction_ids), from_id or max(transaction_ids)))
+        elif from_id:
+            self.fetched_ranges.append((from_id, from_id))
+
+def decode_context_id(journal_entry, entity_doc, division, transaction_index):
     """ entry point for handling context_ids, would look better with a switch but alas this is python """
     # note that that schema used for contexts is totally different from what we get from ESI, a list of dicts is used
     journal_entry['context'] = [{}]
     
     # hopefully the context_id is in the database, otherwise a lot of work must be done to decode it
-    id_filter = {'id': journal_entry['context_id']}
-    result = shared.db.entities.find_one(id_filter)
+    result = shared.find_entity(journal_entry['context_id'])
     if result:
         journal_entry['context'][0]['id'] = result['id']
         journal_entry['context'][0]['name'] = result['name']
@@ -50,7 +113,7 @@ def decode_context_id(journal_entry, entity_doc, division):
             journal_entry['context'][0]['type'] = result['type']
     # market_transaction_ids are a lot more work to decide and extra contexts must be added, so those are handled separately
     elif journal_entry['context_id_type'] == 'market_transaction_id':
-        update_market_transaction(journal_entry, entity_doc, division)
+        update_market_transaction(journal_entry, entity_doc, division, transaction_index)
     elif journal_entry['context_id_type'] == 'station_id':
         result = update_station(journal_entry['context_id'])
         if result:
@@ -66,63 +129,42 @@ def decode_context_id(journal_entry, entity_doc, division):
     del journal_entry['context_id']
     del journal_entry['context_id_type']
     
-def update_market_transaction(journal_entry, entity_doc, division):
+def update_market_transaction(journal_entry, entity_doc, division, transaction_index):
     """ adds stations (or locations) and item type to market_transaction_ids """
     #CCPls fix bug
     if journal_entry['context_id'] == 1:
         return
-    if not division:
-        op = shared.esiapp.op['get_characters_character_id_wallet_transactions'](
-            character_id=entity_doc['id'],
-            from_id=journal_entry['context_id']
-        )
-    else:
-        op = shared.esiapp.op['get_corporations_corporation_id_wallets_division_transactions'](
-            corporation_id=entity_doc['id'],
-            division=division,
-            from_id=journal_entry['context_id']
-        )
-    public_data = shared.esiclient.request(op)
-    if public_data.status != 200:
-        logger.error('status: ' + str(public_data.status) + ' error with getting market transaction: ' + str(public_data.data))
-        logger.error('headers: ' + str(public_data.header))
-        logger.error('entity with error: ' + str(entity_doc['id']))
-    else:
-        for transaction in public_data.data:
-            if transaction['transaction_id'] == journal_entry['context_id']:
-                journal_entry['unit_price'] = transaction['unit_price']
-                journal_entry['quantity'] = transaction['quantity']
-                journal_entry['context'][0]['id'] = journal_entry['context_id']
-                journal_entry['context'][0]['type'] = journal_entry['context_id_type']
-                journal_entry['context'].append({})
-                journal_entry['context'][1]['id'] = transaction['location_id']
-                journal_entry['context'][1]['type'] = 'location_id'
-                journal_entry['context'].append({})
-                journal_entry['context'][2]['id'] = transaction['type_id']
-                journal_entry['context'][2]['type'] = 'item'
-                id_filter = {'id': transaction['type_id']}
-                result = shared.db.entities.find_one(id_filter)
-                if result is None:
-                    result = update_item(transaction['type_id'], 'item')
-                if result:
-                    journal_entry['context'][2]['name'] = result['name']
-                id_filter = {'id': transaction['location_id']}
-                result = shared.db.entities.find_one(id_filter)
-                if result is None:
-                    result = update_station(transaction['location_id'])
-                if result:
-                    journal_entry['context'][1]['name'] = result['name']
-                    journal_entry['context'][1]['type'] = result['type']
-                    journal_entry['context'][1]['type_id'] = result['type_id']
-                if journal_entry['ref_type'] == 'market_escrow' and journal_entry['first_party_id'] == journal_entry['second_party_id']:
-                    journal_entry['second_party_id'] = transaction['client_id']
-                    result = shared.decode_party_id(journal_entry['second_party_id'])
-                    if result:
-                        journal_entry['second_party_name'] = result['name']
-                        journal_entry['second_party_type'] = result['type']
-                return
-            elif transaction['transaction_id'] < journal_entry['context_id']:
-                break
+    transaction = transaction_index.get(journal_entry['context_id'])
+    if transaction is not None:
+        journal_entry['unit_price'] = transaction['unit_price']
+        journal_entry['quantity'] = transaction['quantity']
+        journal_entry['context'][0]['id'] = journal_entry['context_id']
+        journal_entry['context'][0]['type'] = journal_entry['context_id_type']
+        journal_entry['context'].append({})
+        journal_entry['context'][1]['id'] = transaction['location_id']
+        journal_entry['context'][1]['type'] = 'location_id'
+        journal_entry['context'].append({})
+        journal_entry['context'][2]['id'] = transaction['type_id']
+        journal_entry['context'][2]['type'] = 'item'
+        result = shared.find_entity(transaction['type_id'])
+        if result is None:
+            result = update_item(transaction['type_id'], 'item')
+        if result:
+            journal_entry['context'][2]['name'] = result['name']
+        result = shared.find_entity(transaction['location_id'])
+        if result is None:
+            result = update_station(transaction['location_id'])
+        if result:
+            journal_entry['context'][1]['name'] = result['name']
+            journal_entry['context'][1]['type'] = result['type']
+            journal_entry['context'][1]['type_id'] = result['type_id']
+        if journal_entry['ref_type'] == 'market_escrow' and journal_entry['first_party_id'] == journal_entry['second_party_id']:
+            journal_entry['second_party_id'] = transaction['client_id']
+            result = shared.decode_party_id(journal_entry['second_party_id'])
+            if result:
+                journal_entry['second_party_name'] = result['name']
+                journal_entry['second_party_type'] = result['type']
+        return
     # if ESI fails or the market_transaction simply isn't in the ESI response,
     # the journal entry is added to a special field so it can be processed on the next journal update
     logger.info('market transaction ID ' + str(journal_entry['context_id']) + ' not found in transaction data, probably bad cache timing.  Will try again later.')
@@ -141,6 +183,8 @@ def update_market_transaction(journal_entry, entity_doc, division):
     
 def update_station(station_id):
     """ adds a previously unknown station to the DB and returns it """
+    if not config.STATIC_DATA_ESI_FALLBACK:
+        return
     if station_id > 100000000:
         logger.info('Station ID out of range: ' + str(station_id) + ', it is probably a citadel.')
         return
@@ -157,11 +201,11 @@ def update_station(station_id):
         logger.error('system with error: ' + str(station_id))
         return
     data_to_update['name'] = public_data.data['name']
+    data_to_update['search_grams'] = name_grams(data_to_update['name'])
     data_to_update['type_id'] = public_data.data['type_id']
     data_to_update['system_id'] = public_data.data['system_id']
     
-    id_filter = {'id': public_data.data['system_id']}
-    result = shared.db.entities.find_one(id_filter)
+    result = shared.find_entity(public_data.data['system_id'])
     if result is None:
         update_system(public_data.data['system_id'])
     
@@ -172,6 +216,8 @@ def update_station(station_id):
 
 def update_system(system_id):
     """ adds a previously unknown system to the DB and returns it """
+    if not config.STATIC_DATA_ESI_FALLBACK:
+        return
     data_to_update = {}
     data_to_update['id'] = system_id
     data_to_update['type'] = 'system'
@@ -185,13 +231,13 @@ def update_system(system_id):
         logger.error('system with error: ' + str(system_id))
         return
     data_to_update['name'] = public_data.data['name']
+    data_to_update['search_grams'] = name_grams(data_to_update['name'])
     data_to_update['security_status'] = public_data.data['security_status']
     data_to_update['constellation_id'] = public_data.data['constellation_id']
     if 'stations' in public_data.data:
         data_to_update['stations'] = public_data.data['stations']
     
-    id_filter = {'id': public_data.data['constellation_id']}
-    result = shared.db.entities.find_one(id_filter)
+    result = shared.find_entity(public_data.data['constellation_id'])
     if result is None:
         contellation_name, region_name, region_id = update_constellation(public_data.data['constellation_id'])
         if not contellation_name:
@@ -210,6 +256,8 @@ def update_system(system_id):
 
 def update_constellation(constellation_id):
     """ adds a previously unknown constellation to the DB and returns it """
+    if not config.STATIC_DATA_ESI_FALLBACK:
+        return False, False, False
     data_to_update = {}
     data_to_update['id'] = constellation_id
     data_to_update['type'] = 'constellation'
@@ -223,11 +271,11 @@ def update_constellation(constellation_id):
         logger.error('constellation with error: ' + str(constellation_id))
         return False, False, False
     data_to_update['name'] = public_data.data['name']
+    data_to_update['search_grams'] = name_grams(data_to_update['name'])
     data_to_update['systems'] = public_data.data['systems']
     data_to_update['region_id'] = public_data.data['region_id']
     
-    id_filter = {'id': public_data.data['region_id']}
-    result = shared.db.entities.find_one(id_filter)
+    result = shared.find_entity(public_data.data['region_id'])
     if result is None:
         region_name = update_region(public_data.data['region_id'])
         if not region_name:
@@ -243,6 +291,8 @@ def update_constellation(constellation_id):
 
 def update_region(region_id):
     """ adds a previously unknown region to the DB and returns it """
+    if not config.STATIC_DATA_ESI_FALLBACK:
+        return False
     data_to_update = {}
     data_to_update['id'] = region_id
     data_to_update['type'] = 'region'
@@ -256,6 +306,7 @@ def update_region(region_id):
         logger.error('region with error: ' + str(region_id))
         return False
     data_to_update['name'] = public_data.data['name']
+    data_to_update['search_grams'] = name_grams(data_to_update['name'])
     data_to_update['constellations'] = public_data.data['constellations']
     data_to_update['description'] = public_data.data['description']
     
@@ -266,6 +317,8 @@ def update_region(region_id):
 
 def update_item(item_id, item_type):
     """ adds a previously unknown item to the DB and returns it """
+    if not config.STATIC_DATA_ESI_FALLBACK:
+        return
     data_to_update = {}
     data_to_update['id'] = item_id
     data_to_update['type'] = item_type
@@ -282,10 +335,10 @@ def update_item(item_id, item_type):
         logger.error('item with error: ' + str(item_id))
         return
     data_to_update['name'] = public_data.data['name']
+    data_to_update['search_grams'] = name_grams(data_to_update['name'])
     data_to_update['group_id'] = public_data.data['group_id']
     
-    id_filter = {'id': public_data.data['group_id']}
-    result = shared.db.entities.find_one(id_filter)
+    result = shared.find_entity(public_data.data['group_id'])
     if result is None:
         op = shared.esiapp.op['get_universe_groups_group_id'](
             group_id=public_data.data['group_id']
@@ -301,6 +354,7 @@ def update_item(item_id, item_type):
         group_data['type'] = 'group'
         group_data['types'] = public_data.data['types']
         group_data['name'] = public_data.data['name']
+        group_data['search_grams'] = name_grams(group_data['name'])
         data_to_update_id = {'id': group_data['id']}
         update = {"$set": group_data}
         shared.db.entities.update_one(data_to_update_id, update, upsert=True)
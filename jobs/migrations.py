@@ -0,0 +1,85 @@
+"""
+ contains jobs that backfill fields added to existing documents, new documents get these fields when they are written
+ they can be queued like other jobs, or run directly with: python -m jobs.migrations <job name>
+ backfill_journal_alliance_ids finds journal entries through 'parties' and 'party_flows',
+ so backfill_journal_parties and backfill_journal_party_flows have to finish first
+"""
+
+from pymongo import UpdateOne
+
+from jobs import shared
+from jobs.shared import logger
+
+from app.flask_shared_modules import rq
+from app.search_index import name_grams
+
+import config
+
+import sys
+
+@rq.job(timeout=86400)
+def backfill_journal_parties():
+    """ adds the 'parties' array to journal entries written before it existed """
+    backfill(shared.db.journals, {'parties': {'$exists': False}}, lambda journal_entry: {
+        '$set': {'parties': shared.journal_parties(journal_entry)}
+    })
+    
+@rq.job(timeout=86400)
+def backfill_journal_party_flows():
+    """ adds the 'party_flows' array to journal entries written before it existed """
+    backfill(shared.db.journals, {'party_flows': {'$exists': False}}, lambda journal_entry: {
+        '$set': {'party_flows': shared.journal_party_flows(journal_entry)}
+    })
+    
+@rq.job(timeout=86400)
+def backfill_search_grams():
+    """ adds the 'search_grams' used by the search index to entities written before it existed """
+    backfill(shared.db.entities, {'name': {'$exists': True}, 'search_grams': {'$exists': False}}, lambda entity_doc: {
+        '$set': {'search_grams': name_grams(entity_doc['name'])}
+    })
+    
+@rq.job(timeout=86400)
+def backfill_journal_alliance_ids():
+    """ stamps every alliance on the journal entries of its current corps, in alliance_ids and party_flows """
+    try:
+        # entries without 'parties' or 'party_flows' would silently be left without their alliances
+        missing_filter = {'$or': [{'parties': {'$exists': False}}, {'party_flows': {'$exists': False}}]}
+        if shared.db.journals.find_one(missing_filter, {'id': 1}) is not None:
+            logger.error('journal entries are missing parties or party_flows, run backfill_journal_parties ' +
+                         'and backfill_journal_party_flows before the alliance backfill')
+            return
+        for alliance_doc in shared.db.entities.find({'type': 'alliance', 'corps': {'$exists': True}}, {'id': 1, 'corps': 1}):
+            shared.update_alliance_journals(alliance_doc['id'], [], alliance_doc['corps'])
+        logger.info('done alliance journal backfill')
+    except Exception as e:
+        logger.exception(e)
+        return
+    
+def backfill(collection, doc_filter, make_update):
+    """
+    applies make_update(doc) to every document in collection matching doc_filter, MIGRATION_BATCH_SIZE at a time
+    documents are walked by id so each batch is an index seek no matter how far the backfill has gone
+    """
+    try:
+        logger.info('start ' + collection.name + ' backfill of ' + str(doc_filter))
+        updated_count = 0
+        last_id = None
+        while True:
+            batch_filter = dict(doc_filter)
+            if last_id is not None:
+                batch_filter['id'] = {'$lt': last_id}
+            batch = list(collection.find(batch_filter).sort('id', -1).limit(config.MIGRATION_BATCH_SIZE))
+            if len(batch) == 0:
+                break
+            requests = [UpdateOne({'id': doc['id']}, make_update(doc)) for doc in batch]
+            result = collection.bulk_write(requests, ordered=False)
+            updated_count += result.modified_count
+            last_id = batch[-1]['id']
+            logger.info(collection.name + ' backfill reached id ' + str(last_id) + ', ' + str(updated_count) + ' documents updated')
+        logger.info('done ' + collection.name + ' backfill, ' + str(updated_count) + ' documents updated')
+    except Exception as e:
+        logger.exception(e)
+        return
+
+if __name__ == '__main__':
+    globals()[sys.argv[1]]()
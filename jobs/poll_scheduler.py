@@ -0,0 +1,140 @@
+"""
+ contains the job that schedules wallet refreshes per character and per corp
+ the next time each entity is due is kept in a redis sorted set, see wallet_refresh.next_poll_time() for how it is chosen
+ members of the set are 'character:<character_id>' or 'corporation:<corporation_id>'
+"""
+
+from jobs import shared
+from jobs.shared import logger
+from jobs import wallet_refresh
+from app.flask_shared_modules import rq
+from app.flask_shared_modules import r
+from app.flask_shared_modules import esi_limiter
+
+import config
+
+from datetime import datetime
+from datetime import timezone
+
+poll_schedule_key = 'wallet_poll_schedule'
+
+character_scope = 'esi-wallet.read_character_wallet.v1'
+corp_scope = 'esi-wallet.read_corporation_wallets.v1'
+
+@rq.job
+def process_due_wallets():
+    """
+    finds all characters and corps whose next poll time has passed and refreshes them,
+    either by queueing a job per entity (WALLET_REFRESH_FAN_OUT) or with this job's own thread pool
+    """
+    try:
+        now = datetime.utcnow().replace(tzinfo=timezone.utc).timestamp()
+        # only the fields needed to work out who can be polled, the tokens are loaded per due member
+        user_docs = shared.db.entities.find({ 'tokens': { '$exists': True } },
+                                            {'id': 1, 'scopes': 1, 'corporation_id': 1})
+        pollable_members = get_pollable_members(user_docs)
+        add_new_members(pollable_members, now)
+        
+        due_members = [member.decode('utf-8') for member in
+                       r.zrangebyscore(poll_schedule_key, 0, now, start=0, num=config.POLL_BATCH_SIZE)]
+        if len(due_members) == 0:
+            return
+        logger.debug('start polling ' + str(len(due_members)) + ' due wallets')
+        
+        # due members are leased until the job timeout, so a slow run can't be dispatched twice
+        pipe = r.pipeline()
+        for member in due_members:
+            if member in pollable_members:
+                pipe.execute_command('ZADD', poll_schedule_key, now + config.DEFAULT_TIMEOUT, member)
+            else:
+                # the entity no longer has a token with a wallet scope
+                pipe.zrem(poll_schedule_key, member)
+        pipe.execute()
+        
+        due_members = [member for member in due_members if member in pollable_members]
+        if config.WALLET_REFRESH_FAN_OUT:
+            enqueue_members(due_members)
+        else:
+            wallet_refresh.run_in_workers(refresh_member, due_members)
+        
+        logger.debug('esi limiter stats: ' + str(esi_limiter.stats()))
+        logger.debug('entity cache stats: ' + str(shared.entity_cache.stats()))
+        logger.debug('done dispatching due wallets')
+    except Exception as e:
+        logger.exception(e)
+        return
+    
+def enqueue_members(members):
+    """
+    queues one refresh_member job per entity so they are spread over all rq workers,
+    job ids are deterministic so an entity that is still queued or running isn't queued again
+    """
+    queue = rq.get_queue()
+    queued_count = 0
+    for member in members:
+        job_id = 'refresh_wallet-' + member
+        existing_job = queue.fetch_job(job_id)
+        if existing_job is not None and existing_job.get_status() in ('queued', 'started', 'deferred'):
+            continue
+        refresh_member.queue(member, job_id=job_id, result_ttl=0)
+        queued_count += 1
+    logger.debug('queued ' + str(queued_count) + ' wallet refresh jobs')
+    
+@rq.job
+def refresh_member(member):
+    """
+    refreshes the wallet of one character or corp, the full user docs are loaded here
+    as the dispatcher only reads a projection and the tokens may have changed since dispatch
+    """
+    try:
+        entity_type, entity_id = member.split(':')
+        if entity_type == 'character':
+            user_filter = {'id': int(entity_id), 'tokens': {'$exists': True}}
+        else:
+            user_filter = {'corporation_id': int(entity_id), 'tokens': {'$exists': True}}
+        pollable_members = get_pollable_members(shared.db.entities.find(user_filter))
+        if member not in pollable_members:
+            r.zrem(poll_schedule_key, member)
+            return
+        poll_member(member, pollable_members[member])
+    except Exception as e:
+        logger.exception(e)
+        return
+    
+def poll_member(member, user_docs):
+    """ refreshes one character or corp and schedules its next poll """
+    next_poll = None
+    for user_doc in user_docs:
+        try:
+            if member.startswith('character:'):
+                next_poll = wallet_refresh.process_character(user_doc)
+            else:
+                next_poll = wallet_refresh.process_corp(user_doc)
+        except wallet_refresh.JournalError:
+            logger.error('Aborting wallet processing for: ' + member + ' with character ' + str(user_doc['id']))
+        if next_poll is not None:
+            break
+    if next_poll is None:
+        next_poll = datetime.utcnow().replace(tzinfo=timezone.utc).timestamp() + config.POLL_MIN_INTERVAL
+    r.execute_command('ZADD', poll_schedule_key, next_poll, member)
+    
+def get_pollable_members(user_docs):
+    """
+    returns a dict of schedule members to the characters whose tokens can be used to poll them,
+    a corp can be polled by any of its characters that has the corp wallet scope
+    """
+    pollable_members = {}
+    for user_doc in user_docs:
+        scopes = (user_doc.get('scopes') or '').split(' ')
+        if character_scope in scopes:
+            pollable_members['character:' + str(user_doc['id'])] = [user_doc]
+        if corp_scope in scopes and 'corporation_id' in user_doc:
+            pollable_members.setdefault('corporation:' + str(user_doc['corporation_id']), []).append(user_doc)
+    return pollable_members
+    
+def add_new_members(pollable_members, now):
+    """ newly linked characters and corps are due immediately, NX leaves already scheduled members alone """
+    pipe = r.pipeline()
+    for member in pollable_members:
+        pipe.execute_command('ZADD', poll_schedule_key, 'NX', now, member)
+    pipe.execute()
@@ -1,6 +1,6 @@
 """
- updates all info on all entities that don't require ESI tokens to update
- this can take a long time for a large DB, even though most info will remain the same
+ updates info on entities that don't require ESI tokens to update
+ each run only refreshes the entities that were tried the longest time ago, so the whole DB is covered over several runs
  note that some entities that are 'static' don't get updated, like systems and items
 """
 
@@ -9,25 +9,78 @@ from jobs.shared import logger
 
 from app.flask_shared_modules import rq
 
+import config
+
+from datetime import datetime
+from datetime import timezone
+
 @rq.job
 def update_all_public_info():
     try:
         logger.debug('start public info refresh')
     
-        entity_cursor = shared.db.entities.find({})
-        for entity_doc in entity_cursor:
-            if 'type' not in entity_doc:
-                logger.error('DB entry ' + entity_doc.id + ' does not have a type')
-                continue
-            elif entity_doc['type'] == 'character':
-                shared.user_update(entity_doc['id'])
+        # entities that have never been tried have no public_refresh_attempted_at, so they are sorted first
+        stale_filter = {'type': {'$in': ['character', 'corporation', 'alliance']}}
+        stale_projection = {'id': 1, 'type': 1, 'corporation_id': 1, 'alliance_id': 1}
+        entity_cursor = shared.db.entities.find(stale_filter, stale_projection)
+        entity_cursor.sort('public_refresh_attempted_at', 1).limit(config.PUBLIC_REFRESH_BATCH_SIZE)
+        entity_docs = list(entity_cursor)
+        
+        # every attempt is stamped, not only successful ones, so entities that always fail (like deleted characters)
+        # go to the back of the queue instead of being picked first on every run
+        now_utc = datetime.utcnow().replace(tzinfo=timezone.utc)
+        attempted_filter = {'id': {'$in': [entity_doc['id'] for entity_doc in entity_docs]}}
+        shared.db.entities.update_many(attempted_filter, {'$set': {'public_refresh_attempted_at': now_utc.timestamp()}})
+        
+        character_docs = []
+        for entity_doc in entity_docs:
+            if entity_doc['type'] == 'character':
+                character_docs.append(entity_doc)
             elif entity_doc['type'] == 'corporation':
                 shared.corp_update(entity_doc['id'])
             elif entity_doc['type'] == 'alliance':
                 shared.alliance_update(entity_doc['id'])
+        
+        # the affiliation endpoint accepts up to 1000 characters per request
+        for start in range(0, len(character_docs), 1000):
+            update_character_affiliations(character_docs[start:start + 1000])
     
-        logger.debug('done public info refresh')
+        logger.debug('done public info refresh, ESI cache: ' + str(shared.esi_cache.stats()))
     except Exception as e:
         logger.exception(e)
         return
-        
\ No newline at end of file
+    
+def update_character_affiliations(character_docs):
+    """
+    checks the corp and alliance of many characters with a single request,
+    only characters whose affiliation changed get a full user_update
+    """
+    op = shared.esiapp.op['post_characters_affiliation'](
+        characters=[character_doc['id'] for character_doc in character_docs]
+    )
+    affiliation_data = shared.uncached_esiclient.request(op)
+    if affiliation_data.status != 200:
+        logger.error('status: ' + str(affiliation_data.status) + ' error with getting affiliation data: ' + str(affiliation_data.data))
+        logger.error('headers: ' + str(affiliation_data.header))
+        for character_doc in character_docs:
+            shared.user_update(character_doc['id'])
+        return
+    
+    affiliations = {}
+    for affiliation in affiliation_data.data:
+        affiliations[affiliation['character_id']] = affiliation
+    
+    unchanged_ids = []
+    for character_doc in character_docs:
+        affiliation = affiliations.get(character_doc['id'])
+        if (affiliation is None or
+                affiliation['corporation_id'] != character_doc.get('corporation_id') or
+                affiliation.get('alliance_id') != character_doc.get('alliance_id')):
+            shared.user_update(character_doc['id'])
+        else:
+            unchanged_ids.append(character_doc['id'])
+    
+    if len(unchanged_ids) > 0:
+        now_utc = datetime.utcnow().replace(tzinfo=timezone.utc)
+        update = {'$set': {'public_refreshed_at': now_utc.timestamp()}}
+        shared.db.entities.update_many({'id': {'$in': unchanged_ids}}, update)
@@ -5,14 +5,28 @@
 
 from pymongo import MongoClient
 from pymongo import ReturnDocument
+from bson.son import SON
 
 from app.flask_shared_modules import esiapp
 from app.flask_shared_modules import esiclient
+from app.flask_shared_modules import uncached_esiclient
 from app.flask_shared_modules import esisecurity
+from app.flask_shared_modules import create_esisecurity
+from app.flask_shared_modules import create_esiclient
+from app.flask_shared_modules import entity_cache
+from app.flask_shared_modules import esi_cache
+from app.flask_shared_modules import r
+from app.flask_shared_modules import journal_version_key
+from app.flask_shared_modules import all_journals_version
+from app.search_index import name_grams
 
 import config
 
 import logging
+import threading
+import uuid
+from datetime import datetime
+from datetime import timedelta
 from datetime import timezone
 
 # setup the logger that is used by all jobs
@@ -31,12 +45,46 @@ db = MongoClient(config.MONGO_HOST, config.MONGO_PORT, connect=config.MONGO_CONN
 esiapp = esiapp
 esisecurity = esisecurity
 esiclient = esiclient
+uncached_esiclient = uncached_esiclient
+
+# each thread that makes authed ESI calls gets its own security object and client, see get_worker_esi()
+worker_esi = threading.local()
+
+def get_worker_esi():
+    """
+    returns the (esisecurity, esiclient) pair owned by the current thread, creating it on first use
+    the global esisecurity holds a single token, so it can't be shared by threads processing different characters,
+    the clients all share the process's connection pool, so connections outlive the short lived worker threads
+    """
+    if not hasattr(worker_esi, 'client'):
+        worker_esi.security = create_esisecurity()
+        worker_esi.client = create_esiclient(worker_esi.security)
+    return worker_esi.security, worker_esi.client
+
+def etag_params(entity_id, operation, page=1):
+    """
+    returns the extra op parameters for a conditional request, ESI answers 304 if the response
+    still has the etag that was saved with save_etag() the last time it was processed
+    """
+    etag = r.get(etag_key(entity_id, operation, page))
+    if etag is None:
+        return {}
+    return {'If-None-Match': etag.decode('utf-8')}
+
+def save_etag(entity_id, operation, response, page=1):
+    """ saves the etag of a response once it has been fully processed """
+    if 'ETag' in response.header:
+        r.setex(etag_key(entity_id, operation, page), config.ETAG_TTL, response.header['ETag'][0])
+
+def etag_key(entity_id, operation, page):
+    return 'etag:' + str(entity_id) + ':' + operation + ':' + str(page)
 
 def user_update(character_id, public_data=None):
     """ adds or updates a DB entry for a user (character) and returns it """
     data_to_update = {}
     data_to_update['id'] = character_id
     data_to_update['type'] = 'character'
+    data_to_update['public_refreshed_at'] = datetime.utcnow().replace(tzinfo=timezone.utc).timestamp()
     data_to_remove = None
     if not public_data:
         op = esiapp.op['get_characters_character_id'](
@@ -49,6 +97,7 @@ def user_update(character_id, public_data=None):
             logger.error('character with issue: ' + str(character_id))
             return
     data_to_update['name'] = public_data.data['name']
+    data_to_update['search_grams'] = name_grams(data_to_update['name'])
     data_to_update['birthday'] = public_data.data['birthday'].v.replace(tzinfo=timezone.utc).strftime("%Y-%m-%d %X")
     data_to_update['corporation_id'] = public_data.data['corporation_id']
     if 'alliance_id' in public_data.data:
@@ -61,6 +110,7 @@ def user_update(character_id, public_data=None):
     if data_to_remove:
         update['$unset'] = data_to_remove
     new_user_doc = db.entities.find_one_and_update(character_filter, update, upsert=True, return_document=ReturnDocument.AFTER)
+    entity_cache.set(character_id, new_user_doc)
     decode_party_id(data_to_update['corporation_id'])
     if 'alliance_id' in public_data.data:
         decode_party_id(data_to_update['alliance_id'])
@@ -71,6 +121,7 @@ def corp_update(corporation_id, public_data=None):
     data_to_update = {}
     data_to_update['id'] = corporation_id
     data_to_update['type'] = 'corporation'
+    data_to_update['public_refreshed_at'] = datetime.utcnow().replace(tzinfo=timezone.utc).timestamp()
     data_to_remove = None
     if not public_data:
         op = esiapp.op['get_corporations_corporation_id'](
@@ -85,6 +136,7 @@ def corp_update(corporation_id, public_data=None):
     data_to_update['ceo_id'] = public_data.data['ceo_id']
     data_to_update['member_count'] = public_data.data['member_count']
     data_to_update['name'] = public_data.data['name']
+    data_to_update['search_grams'] = name_grams(data_to_update['name'])
     data_to_update['tax_rate'] = public_data.data['tax_rate']
     data_to_update['ticker'] = public_data.data['ticker']
     if 'alliance_id' in public_data.data:
@@ -99,6 +151,7 @@ def corp_update(corporation_id, public_data=None):
     if data_to_remove:
         update['$unset'] = data_to_remove
     new_corp_doc = db.entities.find_one_and_update(corporation_filter, update, upsert=True, return_document=ReturnDocument.AFTER)
+    entity_cache.set(corporation_id, new_corp_doc)
     decode_party_id(data_to_update['ceo_id'])
     if 'alliance_id' in public_data.data:
         decode_party_id(data_to_update['alliance_id'])
@@ -110,6 +163,7 @@ def alliance_update(alliance_id, public_data=None):
     data_to_update = {}
     data_to_update['id'] = alliance_id
     data_to_update['type'] = 'alliance'
+    data_to_update['public_refreshed_at'] = datetime.utcnow().replace(tzinfo=timezone.utc).timestamp()
     if not public_data:
         op = esiapp.op['get_alliances_alliance_id'](
             alliance_id=alliance_id
@@ -122,6 +176,7 @@ def alliance_update(alliance_id, public_data=None):
             return
     data_to_update['date_founded'] = public_data.data['date_founded'].v.replace(tzinfo=timezone.utc).strftime("%Y-%m-%d %X")
     data_to_update['name'] = public_data.data['name']
+    data_to_update['search_grams'] = name_grams(data_to_update['name'])
     data_to_update['ticker'] = public_data.data['ticker']
     if 'executor_corporation_id' in public_data.data:
         data_to_update['executor_corporation_id'] = public_data.data['executor_corporation_id']
@@ -135,11 +190,14 @@ def alliance_update(alliance_id, public_data=None):
         logger.error('headers: ' + str(public_data.header))
         logger.error('alliance with issue: ' + str(alliance_id))
         return
-    data_to_update['corps'] = public_data.data
+    data_to_update['corps'] = list(public_data.data)
     
     alliance_filter = {'id': alliance_id}
     update = {"$set": data_to_update}
-    new_alliance_doc = db.entities.find_one_and_update(alliance_filter, update, upsert=True, return_document=ReturnDocument.AFTER)
+    old_alliance_doc = db.entities.find_one_and_update(alliance_filter, update, upsert=True, return_document=ReturnDocument.BEFORE)
+    new_alliance_doc = dict(old_alliance_doc or {}, **data_to_update)
+    entity_cache.set(alliance_id, new_alliance_doc)
+    update_alliance_journals(alliance_id, (old_alliance_doc or {}).get('corps') or [], data_to_update['corps'])
     if 'executor_corporation_id' in public_data.data:
         decode_party_id(data_to_update['executor_corporation_id'])
     for corp in public_data.data:
@@ -147,31 +205,271 @@ def alliance_update(alliance_id, public_data=None):
     return new_alliance_doc
 
 
+def find_entity(entity_id):
+    """ returns the DB entry for an entity (without its tokens), served from the entity cache when possible """
+    return entity_cache.get(entity_id, lambda entity_id: db.entities.find_one({'id': entity_id}))
+
 def decode_party_id(party_id):
     """ function to handle 'unknown' party_ids.  The search endpoint could also be used but there are only a few party types """
     if party_id <= 2:
         return
-    id_filter = {'id': party_id}
-    result = db.entities.find_one(id_filter)
+    result = find_entity(party_id)
     if result is not None:
         return result
+    if is_unresolvable(party_id):
+        return
+    failed_statuses = []
     op = esiapp.op['get_characters_character_id'](
         character_id=party_id
     )
     result = esiclient.request(op)
     if result.status == 200:
         return user_update(party_id, result)
+    failed_statuses.append(result.status)
     op = esiapp.op['get_corporations_corporation_id'](
         corporation_id=party_id
     )
     result = esiclient.request(op)
     if result.status == 200:
         return corp_update(party_id, result)
+    failed_statuses.append(result.status)
     op = esiapp.op['get_alliances_alliance_id'](
         alliance_id=party_id
     )
     result = esiclient.request(op)
     if result.status == 200:
         return alliance_update(party_id, result)
+    failed_statuses.append(result.status)
     # sometimes the party_id is a '''''''special''''''' value, so most of the time this is no big deal (but could mean error)
     logger.info('No character/corp/alliance found for: ' + str(party_id))
+    # only remember the id if ESI actually answered, server errors and error limiting say nothing about the id
+    if all(status < 500 and status != 420 for status in failed_statuses):
+        mark_unresolvable(party_id)
+
+def resolve_party_ids(party_ids):
+    """
+    resolves many unknown ids at once with ESI's bulk names endpoint instead of guessing each type in decode_party_id
+    only ids that turn out to be characters, corps or alliances get their full *_update calls
+    """
+    unknown_ids = set()
+    for party_id in party_ids:
+        if party_id > 2 and entity_cache.get(party_id) is None:
+            unknown_ids.add(party_id)
+    if not unknown_ids:
+        return
+    # ids that are already in the DB don't need resolving, looking them up also fills the entity cache
+    for entity_doc in db.entities.find({'id': {'$in': list(unknown_ids)}}):
+        entity_cache.set(entity_doc['id'], entity_doc)
+        unknown_ids.discard(entity_doc['id'])
+    unresolvable_filter = {'id': {'$in': list(unknown_ids)}, 'expires': {'$gt': datetime.utcnow()}}
+    for unresolvable_doc in db.unresolvable_ids.find(unresolvable_filter):
+        unknown_ids.discard(unresolvable_doc['id'])
+    
+    unknown_ids = sorted(unknown_ids)
+    for start in range(0, len(unknown_ids), 1000):
+        for name in request_universe_names(unknown_ids[start:start + 1000]):
+            if name['category'] == 'character':
+                user_update(name['id'])
+            elif name['category'] == 'corporation':
+                corp_update(name['id'])
+            elif name['category'] == 'alliance':
+                alliance_update(name['id'])
+            else:
+                mark_unresolvable(name['id'])
+
+def request_universe_names(ids):
+    """
+    returns the names and categories of ids from ESI, which rejects the whole request if any id is invalid
+    so when that happens the ids are split in half until the invalid ones are found
+    """
+    op = esiapp.op['post_universe_names'](
+        ids=ids
+    )
+    result = uncached_esiclient.request(op)
+    if result.status == 200:
+        return list(result.data)
+    if result.status == 404:
+        if len(ids) == 1:
+            mark_unresolvable(ids[0])
+            return []
+        middle = len(ids) // 2
+        return request_universe_names(ids[:middle]) + request_universe_names(ids[middle:])
+    logger.error('status: ' + str(result.status) + ' error with getting universe names: ' + str(result.data))
+    logger.error('headers: ' + str(result.header))
+    return []
+
+def is_unresolvable(party_id):
+    """ returns True if ESI recently failed to find a character/corp/alliance for this id """
+    id_filter = {'id': party_id, 'expires': {'$gt': datetime.utcnow()}}
+    return db.unresolvable_ids.find_one(id_filter) is not None
+
+def mark_unresolvable(party_id):
+    """ records an id that isn't a character/corp/alliance so ESI isn't asked about it again for UNRESOLVABLE_ID_TTL seconds """
+    expires = datetime.utcnow() + timedelta(seconds=config.UNRESOLVABLE_ID_TTL)
+    update = {'$set': {'id': party_id, 'expires': expires}}
+    db.unresolvable_ids.update_one({'id': party_id}, update, upsert=True)
+
+# journal fields that hold the id of an entity the journal entry involves
+journal_party_fields = ('first_party_id', 'second_party_id', 'first_party_corp_id', 'second_party_corp_id', 'tax_receiver_id')
+# journal fields that are only used for querying, they are derived from the other fields by journal_update()
+journal_array_fields = ('parties', 'party_flows', 'alliance_ids')
+
+def journal_parties(journal_entry):
+    """ returns the ids of every entity a journal entry involves, including the ids in its context """
+    parties = []
+    for field in journal_party_fields:
+        if field in journal_entry and journal_entry[field] not in parties:
+            parties.append(journal_entry[field])
+    for context_entry in journal_entry.get('context') or []:
+        if 'id' in context_entry and context_entry['id'] not in parties:
+            parties.append(context_entry['id'])
+    return parties
+
+def journal_party_flows(journal_entry):
+    """
+    returns which way isk moved for each entity a journal entry involves, as {'id': party id, 'dir': 'gain'/'loss'/'neutral'}
+    tax receivers always gain, and entities that are only in the context are neutral
+    """
+    party_flows = []
+    for id_field, amount_field in (('first_party_id', 'first_party_amount'), ('second_party_id', 'second_party_amount'),
+                                   ('first_party_corp_id', 'first_party_amount'), ('second_party_corp_id', 'second_party_amount')):
+        if id_field in journal_entry and amount_field in journal_entry:
+            if journal_entry[amount_field] > 0:
+                direction = 'gain'
+            elif journal_entry[amount_field] < 0:
+                direction = 'loss'
+            else:
+                direction = 'neutral'
+            add_party_flow(party_flows, journal_entry[id_field], direction)
+    if 'tax_receiver_id' in journal_entry:
+        add_party_flow(party_flows, journal_entry['tax_receiver_id'], 'gain')
+    for context_entry in journal_entry.get('context') or []:
+        if 'id' in context_entry:
+            add_party_flow(party_flows, context_entry['id'], 'neutral')
+    return party_flows
+
+# the directions a party_flows entry can have
+flow_directions = ('gain', 'loss', 'neutral')
+
+def journal_alliance_flows(journal_entry, corp_alliances):
+    """
+    returns party_flows entries for the alliances of the corps a journal entry involves, in the direction of their corps,
+    so the alliance tabs are a single index scan instead of an $in over every corp
+    corp_alliances comes from find_corp_alliances(), update_alliance_journals() keeps these current like alliance_ids
+    """
+    corp_candidates = journal_corp_candidates(journal_entry)
+    alliance_flows = []
+    for party_flow in journal_party_flows(journal_entry):
+        if party_flow['id'] in corp_candidates and party_flow['id'] in corp_alliances:
+            add_party_flow(alliance_flows, corp_alliances[party_flow['id']], party_flow['dir'])
+    return alliance_flows
+
+def add_party_flow(party_flows, party_id, direction):
+    # SON keeps the key order fixed, $addToSet only treats embedded documents as equal if their keys are in the same order
+    party_flow = SON([('id', party_id), ('dir', direction)])
+    if party_flow not in party_flows:
+        party_flows.append(party_flow)
+
+def journal_corp_candidates(journal_entry):
+    """
+    returns the ids in a journal entry that can be corps, the other context ids (market transactions, locations, items)
+    are left out so they aren't looked up as entities
+    """
+    candidates = [journal_entry[field] for field in journal_party_fields if field in journal_entry]
+    for context_entry in journal_entry.get('context') or []:
+        if context_entry.get('type') == 'corporation' and 'id' in context_entry:
+            candidates.append(context_entry['id'])
+    return candidates
+
+def find_corp_alliances(journal_entries):
+    """ returns {corp id: alliance id} for the corps in alliances that journal_entries involve, with a single query """
+    candidates = set()
+    for journal_entry in journal_entries:
+        candidates.update(journal_corp_candidates(journal_entry))
+    if len(candidates) == 0:
+        return {}
+    corp_filter = {'id': {'$in': list(candidates)}, 'type': 'corporation', 'alliance_id': {'$exists': True}}
+    return {corp_doc['id']: corp_doc['alliance_id'] for corp_doc in db.entities.find(corp_filter, {'id': 1, 'alliance_id': 1})}
+
+def journal_alliance_ids(journal_entry, corp_alliances):
+    """
+    returns the alliances of the corps a journal entry involves, alliance pages show the entries of all their corps
+    corp_alliances comes from find_corp_alliances(), alliance_update() keeps these current when corps join or leave an alliance
+    """
+    alliance_ids = []
+    for corp_id in journal_corp_candidates(journal_entry):
+        if corp_id in corp_alliances and corp_alliances[corp_id] not in alliance_ids:
+            alliance_ids.append(corp_alliances[corp_id])
+    return alliance_ids
+
+def journal_update(journal_entry, corp_alliances):
+    """
+    returns the update for writing a journal entry, the same entry can be written by each entity involved in it
+    and they don't all know the same fields, so the parties, party_flows and alliance_ids arrays are added to instead of replaced
+    corp_alliances comes from find_corp_alliances()
+    """
+    journal_fields = {key: value for key, value in journal_entry.items() if key not in journal_array_fields}
+    party_flows = journal_party_flows(journal_entry)
+    for alliance_flow in journal_alliance_flows(journal_entry, corp_alliances):
+        add_party_flow(party_flows, alliance_flow['id'], alliance_flow['dir'])
+    return {
+        '$set': journal_fields,
+        '$addToSet': {
+            'parties': {'$each': journal_parties(journal_entry)},
+            'party_flows': {'$each': party_flows},
+            'alliance_ids': {'$each': journal_alliance_ids(journal_entry, corp_alliances)}
+        }
+    }
+
+def update_alliance_journals(alliance_id, old_corps, new_corps):
+    """
+    stamps the alliance on the journal entries of corps that joined it, and removes it from those of corps that left,
+    both in alliance_ids and as party_flows entries in the direction of its corps
+    """
+    joined_corps = [corp for corp in new_corps if corp not in old_corps]
+    left_corps = [corp for corp in old_corps if corp not in new_corps]
+    if len(joined_corps) > 0:
+        result = db.journals.update_many({'parties': {'$in': joined_corps}}, {'$addToSet': {'alliance_ids': alliance_id}})
+        logger.debug('alliance ' + str(alliance_id) + ' added to ' + str(result.modified_count) + ' journal entries')
+        for direction in flow_directions:
+            joined_filter = {'party_flows': {'$elemMatch': {'id': {'$in': joined_corps}, 'dir': direction}}}
+            alliance_flow = SON([('id', alliance_id), ('dir', direction)])
+            db.journals.update_many(joined_filter, {'$addToSet': {'party_flows': alliance_flow}})
+    if len(left_corps) > 0:
+        # entries that also involve a corp still in the alliance keep it
+        left_filter = {'parties': {'$in': left_corps, '$nin': new_corps}, 'alliance_ids': alliance_id}
+        result = db.journals.update_many(left_filter, {'$pull': {'alliance_ids': alliance_id}})
+        logger.debug('alliance ' + str(alliance_id) + ' removed from ' + str(result.modified_count) + ' journal entries')
+        for direction in flow_directions:
+            left_filter = {'$and': [
+                {'party_flows': {'$elemMatch': {'id': {'$in': left_corps}, 'dir': direction}}},
+                {'party_flows': {'$not': {'$elemMatch': {'id': {'$in': new_corps}, 'dir': direction}}}}
+            ]}
+            db.journals.update_many(left_filter, {'$pull': {'party_flows': {'id': alliance_id, 'dir': direction}}})
+    if len(joined_corps) > 0 or len(left_corps) > 0:
+        set_journal_versions([alliance_id])
+
+# context types that have a page of their own, other context ids (market transactions, contracts, ...) are never a version id
+versioned_context_types = ('character', 'corporation', 'alliance', 'station', 'system', 'item', 'ship')
+
+def bump_journal_versions(journal_entries, corp_alliances):
+    """ invalidates the cached journal tables of every page that lists any of journal_entries """
+    version_ids = set([all_journals_version])
+    for journal_entry in journal_entries:
+        version_ids.update(journal_entry[field] for field in journal_party_fields if field in journal_entry)
+        for context_entry in journal_entry.get('context') or []:
+            if context_entry.get('type') in versioned_context_types and 'id' in context_entry:
+                version_ids.add(context_entry['id'])
+        version_ids.update(journal_alliance_ids(journal_entry, corp_alliances))
+    set_journal_versions(version_ids)
+
+def set_journal_versions(version_ids):
+    """
+    gives each version id a new random version, a counter could return to an old value after its key expired
+    and match a page cached before that, the keys expire so ids that are never viewed don't stay in redis
+    """
+    version = uuid.uuid4().hex
+    pipe = r.pipeline(transaction=False)
+    for version_id in version_ids:
+        pipe.set(journal_version_key(version_id), version, ex=config.JOURNAL_VERSION_TTL)
+    pipe.execute()
@@ -0,0 +1,109 @@
+"""
+ converts CCP's static data export (SDE) into the JSON files read by jobs/static_data_import.py
+ download and unzip sde.zip from https://developers.eveonline.com/resource/resources, then run:
+   python -m jobs.static_data_convert <path to unzipped sde> [output path, defaults to STATIC_DATA_PATH]
+ the SDE files used are:
+   fsd/universe/<universe>/<region>/region.staticdata, with constellation.staticdata and solarsystem.staticdata below it
+   bsd/invNames.yaml for region, constellation and system names
+   bsd/staStations.yaml, fsd/groupIDs.yaml and fsd/typeIDs.yaml
+"""
+
+import config
+
+import json
+import os
+import sys
+
+import yaml
+
+# the C loader is many times faster on typeIDs.yaml, but needs PyYAML to be built against libyaml
+try:
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:
+    from yaml import SafeLoader
+
+def convert_sde(sde_path, output_path=None):
+    output_path = output_path or config.STATIC_DATA_PATH
+    os.makedirs(output_path, exist_ok=True)
+
+    names = {row['itemID']: row['itemName'] for row in load_yaml(sde_path, 'bsd', 'invNames.yaml')}
+
+    regions = []
+    constellations = []
+    systems = []
+    universe_path = os.path.join(sde_path, 'fsd', 'universe')
+    for universe in sorted(os.listdir(universe_path)):
+        for region_path in sub_directories(os.path.join(universe_path, universe)):
+            region = load_yaml(region_path, 'region.staticdata')
+            region_data = {'region_id': region['regionID'], 'name': names[region['regionID']], 'constellations': []}
+            regions.append(region_data)
+            for constellation_path in sub_directories(region_path):
+                constellation = load_yaml(constellation_path, 'constellation.staticdata')
+                constellation_data = {'constellation_id': constellation['constellationID'],
+                                      'name': names[constellation['constellationID']],
+                                      'region_id': region['regionID'],
+                                      'systems': []}
+                region_data['constellations'].append(constellation_data['constellation_id'])
+                constellations.append(constellation_data)
+                for system_path in sub_directories(constellation_path):
+                    system = load_yaml(system_path, 'solarsystem.staticdata')
+                    constellation_data['systems'].append(system['solarSystemID'])
+                    systems.append({'system_id': system['solarSystemID'],
+                                    'name': names[system['solarSystemID']],
+                                    'security_status': system['security'],
+                                    'constellation_id': constellation['constellationID']})
+
+    stations = []
+    system_stations = {}
+    for station in load_yaml(sde_path, 'bsd', 'staStations.yaml'):
+        stations.append({'station_id': station['stationID'],
+                         'name': station['stationName'],
+                         'type_id': station['stationTypeID'],
+                         'system_id': station['solarSystemID']})
+        system_stations.setdefault(station['solarSystemID'], []).append(station['stationID'])
+    for system in systems:
+        # like ESI, systems without stations have no 'stations' field
+        if system['system_id'] in system_stations:
+            system['stations'] = system_stations[system['system_id']]
+
+    types = []
+    group_types = {}
+    for type_id, item in load_yaml(sde_path, 'fsd', 'typeIDs.yaml').items():
+        types.append({'type_id': type_id, 'name': english_name(item), 'group_id': item['groupID']})
+        group_types.setdefault(item['groupID'], []).append(type_id)
+
+    groups = []
+    for group_id, group in load_yaml(sde_path, 'fsd', 'groupIDs.yaml').items():
+        groups.append({'group_id': group_id,
+                       'name': english_name(group),
+                       'category_id': group['categoryID'],
+                       'types': group_types.get(group_id, [])})
+
+    write_export_file(output_path, 'regions.json', regions)
+    write_export_file(output_path, 'constellations.json', constellations)
+    write_export_file(output_path, 'systems.json', systems)
+    write_export_file(output_path, 'stations.json', stations)
+    write_export_file(output_path, 'groups.json', groups)
+    write_export_file(output_path, 'types.json', types)
+
+def load_yaml(*path_parts):
+    with open(os.path.join(*path_parts), encoding='utf-8') as yaml_file:
+        return yaml.load(yaml_file, Loader=SafeLoader)
+
+def sub_directories(path):
+    return [os.path.join(path, name) for name in sorted(os.listdir(path)) if os.path.isdir(os.path.join(path, name))]
+
+def english_name(sde_doc):
+    """ SDE names are a dict of language to name, a few old entries are missing some languages or the name entirely """
+    return sde_doc.get('name', {}).get('en', '')
+
+def write_export_file(path, file_name, rows):
+    with open(os.path.join(path, file_name), 'w', encoding='utf-8') as export_file:
+        json.dump(rows, export_file)
+    print(file_name + ': ' + str(len(rows)))
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print('usage: python -m jobs.static_data_convert <path to unzipped sde> [output path]')
+        sys.exit(1)
+    convert_sde(sys.argv[1], sys.argv[2] if len(sys.argv) > 2 else None)
@@ -0,0 +1,127 @@
+"""
+ imports static universe data (regions, constellations, systems, stations, item types and groups) from a local export
+ this fills the DB in one pass, so the context decoders in jobs/context_handler.py don't have to ask ESI for it
+ the export is a directory of JSON files, each holding a list of objects shaped like the matching ESI /universe/ response:
+   regions.json, constellations.json, systems.json, stations.json, types.json, groups.json
+ these are written from CCP's static data export by jobs/static_data_convert.py, so a full import is:
+   python -m jobs.static_data_convert <path to unzipped sde> [path to export]
+   python -m jobs.static_data_import [path to export]
+"""
+
+from pymongo import UpdateOne
+
+from jobs import shared
+from jobs.shared import logger
+
+from app.flask_shared_modules import rq
+from app.search_index import name_grams
+
+import config
+
+import json
+import os
+import sys
+
+# the 'Ship' category, types in these groups are stored as ships instead of items
+SHIP_CATEGORY_ID = 6
+
+@rq.job(timeout=3600)
+def import_static_data(path=None):
+    try:
+        path = path or config.STATIC_DATA_PATH
+        logger.info('start static data import from ' + path)
+
+        regions = load_export_file(path, 'regions.json')
+        constellations = load_export_file(path, 'constellations.json')
+        systems = load_export_file(path, 'systems.json')
+        stations = load_export_file(path, 'stations.json')
+        groups = load_export_file(path, 'groups.json')
+        types = load_export_file(path, 'types.json')
+
+        region_names = {region['region_id']: region['name'] for region in regions}
+        constellations_by_id = {constellation['constellation_id']: constellation for constellation in constellations}
+        ship_group_ids = set(group['group_id'] for group in groups if group['category_id'] == SHIP_CATEGORY_ID)
+
+        requests = []
+        for region in regions:
+            data_to_update = {}
+            data_to_update['id'] = region['region_id']
+            data_to_update['type'] = 'region'
+            data_to_update['name'] = region['name']
+            data_to_update['search_grams'] = name_grams(data_to_update['name'])
+            data_to_update['constellations'] = region['constellations']
+            data_to_update['description'] = region.get('description', '')
+            requests.append(UpdateOne({'id': data_to_update['id']}, {'$set': data_to_update}, upsert=True))
+
+        for constellation in constellations:
+            data_to_update = {}
+            data_to_update['id'] = constellation['constellation_id']
+            data_to_update['type'] = 'constellation'
+            data_to_update['name'] = constellation['name']
+            data_to_update['search_grams'] = name_grams(data_to_update['name'])
+            data_to_update['systems'] = constellation['systems']
+            data_to_update['region_id'] = constellation['region_id']
+            data_to_update['region_name'] = region_names[constellation['region_id']]
+            requests.append(UpdateOne({'id': data_to_update['id']}, {'$set': data_to_update}, upsert=True))
+
+        for system in systems:
+            constellation = constellations_by_id[system['constellation_id']]
+            data_to_update = {}
+            data_to_update['id'] = system['system_id']
+            data_to_update['type'] = 'system'
+            data_to_update['name'] = system['name']
+            data_to_update['search_grams'] = name_grams(data_to_update['name'])
+            data_to_update['security_status'] = system['security_status']
+            data_to_update['constellation_id'] = system['constellation_id']
+            if 'stations' in system:
+                data_to_update['stations'] = system['stations']
+            data_to_update['constellation_name'] = constellation['name']
+            data_to_update['region_id'] = constellation['region_id']
+            data_to_update['region_name'] = region_names[constellation['region_id']]
+            requests.append(UpdateOne({'id': data_to_update['id']}, {'$set': data_to_update}, upsert=True))
+
+        for station in stations:
+            data_to_update = {}
+            data_to_update['id'] = station['station_id']
+            data_to_update['type'] = 'station'
+            data_to_update['name'] = station['name']
+            data_to_update['search_grams'] = name_grams(data_to_update['name'])
+            data_to_update['type_id'] = station['type_id']
+            data_to_update['system_id'] = station['system_id']
+            requests.append(UpdateOne({'id': data_to_update['id']}, {'$set': data_to_update}, upsert=True))
+
+        for group in groups:
+            data_to_update = {}
+            data_to_update['id'] = group['group_id']
+            data_to_update['type'] = 'group'
+            data_to_update['name'] = group['name']
+            data_to_update['search_grams'] = name_grams(data_to_update['name'])
+            data_to_update['types'] = group['types']
+            requests.append(UpdateOne({'id': data_to_update['id']}, {'$set': data_to_update}, upsert=True))
+
+        for item in types:
+            data_to_update = {}
+            data_to_update['id'] = item['type_id']
+            data_to_update['name'] = item['name']
+            data_to_update['search_grams'] = name_grams(data_to_update['name'])
+            data_to_update['group_id'] = item['group_id']
+            # journal entries link to an item by the type it had when they were decoded, so existing types are kept
+            item_type = {'type': 'ship' if item['group_id'] in ship_group_ids else 'item'}
+            update = {'$set': data_to_update, '$setOnInsert': item_type}
+            requests.append(UpdateOne({'id': data_to_update['id']}, update, upsert=True))
+
+        for start in range(0, len(requests), config.STATIC_DATA_BATCH_SIZE):
+            result = shared.db.entities.bulk_write(requests[start:start + config.STATIC_DATA_BATCH_SIZE], ordered=False)
+            logger.info('static data batch: ' + str(result.matched_count) + ' matched, ' + str(result.upserted_count) + ' upserted')
+
+        logger.info('done static data import, ' + str(len(requests)) + ' entities')
+    except Exception as e:
+        logger.exception(e)
+        return
+
+def load_export_file(path, file_name):
+    with open(os.path.join(path, file_name), encoding='utf-8') as export_file:
+        return json.load(export_file)
+
+if __name__ == '__main__':
+    import_static_data(sys.argv[1] if len(sys.argv) > 1 else None)
@@ -0,0 +1,75 @@
+"""
+ contains the job that refreshes SSO tokens shortly before they expire
+ this keeps SSO off the critical path of wallet refreshes, which only refresh a token themselves if it has already run out
+"""
+
+from jobs import shared
+from jobs.shared import logger
+from app.flask_shared_modules import rq
+
+import config
+
+from requests import exceptions
+from esipy.exceptions import APIException
+
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import as_completed
+from datetime import datetime
+from datetime import timedelta
+
+datetime_format = "%Y-%m-%dT%X"
+
+@rq.job
+def refresh_expiring_tokens():
+    """ refreshes every token that expires within TOKEN_REFRESH_AHEAD seconds, TOKEN_REFRESH_WORKERS at a time """
+    try:
+        # ExpiresOn is stored as a string, but its format sorts in time order so it can be compared directly
+        refresh_before = (datetime.utcnow() + timedelta(seconds=config.TOKEN_REFRESH_AHEAD)).strftime(datetime_format)
+        user_docs = list(shared.db.entities.find({'tokens.ExpiresOn': {'$lte': refresh_before}}, {'id': 1, 'tokens': 1}))
+        if len(user_docs) == 0:
+            return
+        logger.debug('start refreshing ' + str(len(user_docs)) + ' tokens')
+        
+        refreshed_count = 0
+        with ThreadPoolExecutor(max_workers=config.TOKEN_REFRESH_WORKERS) as executor:
+            futures = [executor.submit(refresh_user_token, user_doc) for user_doc in user_docs]
+            for future in as_completed(futures):
+                if future.exception() is not None:
+                    logger.error('unexpected error in token refresh worker', exc_info=future.exception())
+                elif future.result():
+                    refreshed_count += 1
+        
+        logger.debug('done refreshing tokens, ' + str(refreshed_count) + ' of ' + str(len(user_docs)) + ' refreshed')
+    except Exception as e:
+        logger.exception(e)
+        return
+    
+def refresh_user_token(user_doc):
+    """ refreshes and saves the token of one character, returns False if the refresh fails """
+    esisecurity = shared.get_worker_esi()[0]
+    tokens = refresh_sso_token(esisecurity, user_doc)
+    if tokens is None:
+        return False
+    shared.db.entities.update_one({'id': user_doc['id']}, {'$set': {'tokens': tokens}})
+    return True
+    
+def refresh_sso_token(esisecurity, user_doc):
+    """ loads the character's token into esisecurity and refreshes it, returns the new tokens or None if SSO refused """
+    access_token_expires = datetime.strptime(user_doc['tokens']['ExpiresOn'], datetime_format)
+    esisecurity.update_token({
+        'access_token': user_doc['tokens']['access_token'],
+        'refresh_token': user_doc['tokens']['refresh_token'],
+        'expires_in': (access_token_expires - datetime.utcnow()).total_seconds()
+    })
+    try:
+        tokens = esisecurity.refresh()
+    except exceptions.SSLError:
+        logger.error('ssl error refreshing token for ' + str(user_doc['id']))
+        return None
+    except APIException as e:
+        logger.error('error refreshing token for: ' + str(user_doc['id']))
+        logger.error('error is: ' + str(e))
+        return None
+    token_expire = datetime.utcnow() + timedelta(seconds=tokens['expires_in'])
+    tokens['ExpiresOn'] = token_expire.strftime(datetime_format)
+    return tokens
@@ -1,68 +1,47 @@
 """
- contains jobs to update both character and corp wallets and journals
+ contains the functions that update both character and corp wallets and journals, scheduled by jobs.poll_scheduler
 """
 
 from jobs import shared
 from jobs.shared import logger
 from jobs import context_handler
-from app.flask_shared_modules import rq
+from jobs import token_refresh
 
-from requests import exceptions
-from esipy.exceptions import APIException
+import config
 
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
+
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import as_completed
 from datetime import datetime
 from datetime import timedelta
 from datetime import timezone
+from email.utils import parsedate_to_datetime
 
 datetime_format = "%Y-%m-%dT%X"
 
+# entity fields kept up to date by process_journal(), corp fields end with the wallet division
+journal_state_fields = ('last_journal_entry', 'last_journal_activity', 'missed_market_transactions')
+
 # custom exception so that journal processing can be aborted on specific errors
 class JournalError(Exception):
     pass
 
-@rq.job
-def process_character_wallets():
-    """ processes character wallets for all characters that have tokens """
-    try:
-        logger.debug('start character wallet refresh')
-
-        user_cursor = shared.db.entities.find({ 'tokens': { '$exists': True } })
-        
-        for user_doc in user_cursor:
-            try:
-                process_character(user_doc)
-            except JournalError:
-                logger.error('Aborting character wallet processing for: ' + str(user_doc['id']))
-            
-        logger.debug('done character wallet refresh')
-    except Exception as e:
-        logger.exception(e)
-        return
-    
-    
-@rq.job
-def process_corp_wallets():
-    """ processes corp wallets for all characters that have tokens """
-    try:
-        logger.debug('start corp wallet refresh')
-
-        user_cursor = shared.db.entities.find({ '$and': [
-                                            {'tokens': { '$exists': True } },
-                                            {'corporation_id': { '$exists': True } }
-                                            ] })
-        for user_doc in user_cursor:
-            try:
-                process_corp(user_doc)
-            except JournalError:
-                logger.error('Aborting corp wallet processing for: ' + str(user_doc['id']))
-    
-        logger.debug('done corp wallet refresh')
-    except Exception as e:
-        logger.exception(e)
-        return
+def run_in_workers(function, items):
+    """ calls function for each item using a pool of WALLET_REFRESH_WORKERS threads and waits for all of them to finish """
+    with ThreadPoolExecutor(max_workers=config.WALLET_REFRESH_WORKERS) as executor:
+        futures = [executor.submit(function, item) for item in items]
+        for future in as_completed(futures):
+            # exceptions are handled by the functions themselves, but an unexpected one shouldn't stop the other workers
+            if future.exception() is not None:
+                logger.error('unexpected error in wallet refresh worker', exc_info=future.exception())
     
 def process_corp(user_doc):
-    """ if the esi token has the correct scope, update the wallet amount and see if it is time for a journal update """
+    """
+    if the esi token has the correct scope, update the wallet amount and see if it is time for a journal update
+    returns the time the corp should next be polled, or None if it couldn't be processed
+    """
     if ('scopes' not in user_doc or
             'esi-wallet.read_corporation_wallets.v1' not in user_doc['scopes'].split(' ')):
         return
@@ -80,11 +59,13 @@ def process_corp(user_doc):
     corp_doc = shared.db.entities.find_one(corp_filter)
     
     corp_data_to_update = {}
+    esiclient = shared.get_worker_esi()[1]
     op = shared.esiapp.op['get_corporations_corporation_id_wallets'](
-        corporation_id=corp_doc['id']
+        corporation_id=corp_doc['id'],
+        **shared.etag_params(corp_doc['id'], 'wallets')
     )
-    wallet = shared.esiclient.request(op)
-    if wallet.status != 200:
+    wallet = esiclient.request(op)
+    if wallet.status != 200 and wallet.status != 304:
         logger.error('status: ' + str(wallet.status) + ' error with getting corp wallet data: ' + str(wallet.data))
         logger.error('headers: ' + str(wallet.header))
         logger.error('error with getting corp wallet data: ' + str(corp_doc['id']))
@@ -98,7 +79,9 @@ def process_corp(user_doc):
             update = {"$set": data_to_update}
             shared.db.entities.update_one(character_filter, update)
         return
-    corp_data_to_update['wallets'] = wallet.data
+    # a 304 means the wallets haven't changed since they were last saved
+    if wallet.status == 200:
+        corp_data_to_update['wallets'] = wallet.data
     
     last_update = datetime.fromtimestamp(corp_doc.get('last_journal_update') or 0.0, timezone.utc)
     now_utc = datetime.utcnow().replace(tzinfo=timezone.utc)
@@ -106,45 +89,73 @@ def process_corp(user_doc):
         for wallet_division in range(1, 8):
             missed_journal_string = 'missed_market_transactions_' + str(wallet_division)
             missed_journal_ids = corp_doc.get(missed_journal_string) or []
-            process_missed_market_transactions(missed_journal_ids, corp_doc, wallet_division)
-            process_journal(1, corp_doc, wallet_division)
+            transaction_index = context_handler.TransactionIndex(corp_doc, wallet_division)
+            process_missed_market_transactions(missed_journal_ids, corp_doc, transaction_index, wallet_division)
+            process_journal(corp_doc, transaction_index, wallet_division)
         corp_data_to_update['last_journal_update'] = now_utc.timestamp()
         
-    corp_filter = {'id': corp_doc['id']}
-    update = {"$set": corp_data_to_update}
-    shared.db.entities.update_one(corp_filter, update)
+    if len(corp_data_to_update) > 0:
+        corp_filter = {'id': corp_doc['id']}
+        update = {"$set": corp_data_to_update}
+        shared.db.entities.update_one(corp_filter, update)
+    shared.save_etag(corp_doc['id'], 'wallets', wallet)
+    return next_poll_time(wallet, corp_doc)
     
 def process_character(user_doc):
-    """ if the esi token has the correct scope, update the wallet amount and see if it is time for a journal update """
+    """
+    if the esi token has the correct scope, update the wallet amount and see if it is time for a journal update
+    returns the time the character should next be polled, or None if it couldn't be processed
+    """
     if ('scopes' not in user_doc or
             'esi-wallet.read_character_wallet.v1' not in user_doc['scopes'].split(' ')):
         return
     data_to_update = {}
     if not refresh_token(user_doc, data_to_update):
         return
+    esiclient = shared.get_worker_esi()[1]
     op = shared.esiapp.op['get_characters_character_id_wallet'](
-        character_id=user_doc['id']
+        character_id=user_doc['id'],
+        **shared.etag_params(user_doc['id'], 'wallet')
     )
-    wallet = shared.esiclient.request(op)
-    if wallet.status != 200:
+    wallet = esiclient.request(op)
+    if wallet.status != 200 and wallet.status != 304:
         logger.error('status: ' + str(wallet.status) + ' error with getting character wallet data: ' + str(wallet.data))
         logger.error('headers: ' + str(wallet.header))
         logger.error('error with getting character wallet data: ' + str(user_doc['id']))
         return
-    data_to_update['wallet'] = wallet.data
+    # a 304 means the wallet hasn't changed since it was last saved
+    if wallet.status == 200:
+        data_to_update['wallet'] = wallet.data
     last_update = datetime.fromtimestamp(user_doc.get('last_journal_update') or 0.0, timezone.utc)
     now_utc = datetime.utcnow().replace(tzinfo=timezone.utc)
     if last_update + timedelta(hours=1) < now_utc:
         missed_journal_ids = user_doc.get('missed_market_transactions') or []
-        process_missed_market_transactions(missed_journal_ids, user_doc)
-        process_journal(1, user_doc)
+        transaction_index = context_handler.TransactionIndex(user_doc)
+        process_missed_market_transactions(missed_journal_ids, user_doc, transaction_index)
+        process_journal(user_doc, transaction_index)
         data_to_update['last_journal_update'] = now_utc.timestamp()
         
-    character_filter = {'id': user_doc['id']}
-    update = {"$set": data_to_update}
-    shared.db.entities.update_one(character_filter, update)
+    if len(data_to_update) > 0:
+        character_filter = {'id': user_doc['id']}
+        update = {"$set": data_to_update}
+        shared.db.entities.update_one(character_filter, update)
+    shared.save_etag(user_doc['id'], 'wallet', wallet)
+    return next_poll_time(wallet, user_doc)
+    
+def next_poll_time(wallet, entity_doc):
+    """
+    returns the timestamp an entity is next due to be polled, entities back off in proportion to how long their
+    journal has been idle, but are never polled before ESI's cached wallet expires or less often than POLL_MAX_INTERVAL
+    """
+    now = datetime.utcnow().replace(tzinfo=timezone.utc).timestamp()
+    idle_time = now - (entity_doc.get('last_journal_activity') or 0.0)
+    delay = min(max(idle_time * config.POLL_IDLE_FACTOR, config.POLL_MIN_INTERVAL), config.POLL_MAX_INTERVAL)
+    if 'Expires' in wallet.header:
+        wallet_expires = parsedate_to_datetime(wallet.header['Expires'][0]).timestamp()
+        delay = max(delay, wallet_expires - now)
+    return now + delay
         
-def process_missed_market_transactions(missed_journal_ids, entity_doc, division=None):
+def process_missed_market_transactions(missed_journal_ids, entity_doc, transaction_index, division=None):
     """ 
     if there are journal entries that are still missing extra context data
     that comes from 'transactions' endpoint, attempt to update those entries
@@ -165,19 +176,25 @@ def process_missed_market_transactions(missed_journal_ids, entity_doc, division=
             result['context_id_type'] = result['context'][0]['type']
             result['context_id'] = result['context'][0]['id']
             result['context'] = [{}]
-            context_handler.update_market_transaction(result, entity_doc, division)
+            context_handler.update_market_transaction(result, entity_doc, division, transaction_index)
             del result['context_id_type']
             del result['context_id']
             id_filter = {'id': result['id']}
-            update = {'$set': result}
+            corp_alliances = shared.find_corp_alliances([result])
+            update = shared.journal_update(result, corp_alliances)
             shared.db.journals.update_one(id_filter, update)
+            shared.bump_journal_versions([result], corp_alliances)
         else:
             logger.error('journal entry in missed market transactions array has wrong context_id/type, this should never happen.')
             logger.error('entity with error: ' + str(entity_doc['id']) + ' journal entry error: ' + str(missed_journal_id))
         
         
 def refresh_token(user_doc, data_to_update={}):
-    """ update the ESI token if necessary returns False if the update fails """
+    """
+    load the ESI token into this thread's security object, returns False if it can't be used
+    tokens are normally refreshed ahead of time by jobs/token_refresh.py, so this only refreshes ones that are about to run out
+    """
+    esisecurity = shared.get_worker_esi()[0]
     access_token_expires = datetime.strptime(user_doc['tokens']['ExpiresOn'], datetime_format)
     sso_data = {
         'access_token': user_doc['tokens']['access_token'],
@@ -186,49 +203,29 @@ def refresh_token(user_doc, data_to_update={}):
             access_token_expires - datetime.utcnow()
         ).total_seconds()
     }
-    shared.esisecurity.update_token(sso_data)
+    esisecurity.update_token(sso_data)
     if sso_data['expires_in'] <= 30:
-        try:
-            tokens = shared.esisecurity.refresh()
-        except exceptions.SSLError:
-            logger.error('ssl error refreshing token for ' + str(user_doc['id']))
-            return False
-        except APIException as e:
-            logger.error('error refreshing token for: ' + str(user_doc['id']))
-            logger.error('error is: ' + str(e))
+        tokens = token_refresh.refresh_sso_token(esisecurity, user_doc)
+        if tokens is None:
             return False
         data_to_update['tokens'] = tokens
-        delta_expire = timedelta(seconds=data_to_update['tokens']['expires_in'])
-        token_expire = datetime.utcnow() + delta_expire
-        data_to_update['tokens']['ExpiresOn'] = token_expire.strftime(datetime_format)
     return True
 
-def process_journal(page, entity_doc, division=None):
-    """ handles updating the journal entries for both characters and corps, also handles pagination for journals """
+def process_journal(entity_doc, transaction_index, division=None):
+    """ handles updating the journal entries for both characters and corps """
     if division:
         last_journal_entry = entity_doc.get('last_journal_entry_' + str(division)) or 0
-        op = shared.esiapp.op['get_corporations_corporation_id_wallets_division_journal'](
-            corporation_id=entity_doc['id'],
-            division=division,
-            page=page
-        )
     else:
         last_journal_entry = entity_doc.get('last_journal_entry') or 0
-        op = shared.esiapp.op['get_characters_character_id_wallet_journal'](
-            character_id=entity_doc['id'],
-            page=page
-        )
-    journal = shared.esiclient.request(op)
-    if journal.status != 200:
-        logger.error('status: ' + str(journal.status) + ' error with getting journal data: ' + str(journal.data))
-        logger.error('headers: ' + str(journal.header))
-        logger.error('error with getting journal data: ' + str(entity_doc['id']))
-        raise JournalError()
-    num_pages = int(journal.header['X-Pages'][0])
-    if page < num_pages and journal.data[-1]['id'] > last_journal_entry:
-        process_journal(page+1, entity_doc, division)
+    journal_operation = 'journal_' + str(division) if division else 'journal'
+    first_page, journal_entries = fetch_journal_pages(entity_doc, division, last_journal_entry, journal_operation)
+    # nothing has changed since the last update if ESI answered 304
+    if first_page.status == 304:
+        return
+    # the types of unknown parties are resolved in bulk first, so decoding each entry only needs the DB
+    shared.resolve_party_ids(collect_party_ids(journal_entries, last_journal_entry))
     new_journal_entries = []
-    for journal_entry in journal.data:
+    for journal_entry in journal_entries:
         if journal_entry['id'] > last_journal_entry:
             if journal_entry['first_party_id'] == entity_doc['id']:
                 journal_entry['first_party_balance'] = journal_entry.pop('balance')
@@ -273,24 +270,120 @@ def process_journal(page, entity_doc, division=None):
                         logger.error(str(journal_entry['id']) + ' is not a corp transaction!  This is bad data!')
                 else:
                     logger.error('Corp amount is 0!  Cant assign the corp to a party, this will lead to bad data.')
-            decode_journal_entry(journal_entry, entity_doc, division)
+            decode_journal_entry(journal_entry, entity_doc, division, transaction_index)
             new_journal_entries.append(journal_entry)
         else:
             break
     if len(new_journal_entries) > 0:
         if division:
-            entity_doc['last_journal_entry' + str(division)] = new_journal_entries[0]['id']
+            entity_doc['last_journal_entry_' + str(division)] = new_journal_entries[0]['id']
         else:
             entity_doc['last_journal_entry'] = new_journal_entries[0]['id']
-        for entry in new_journal_entries:
-            id_filter = {'id': entry['id']}
-            update = {'$set': entry}
-            shared.db.journals.update_one(id_filter, update, upsert=True) 
+        # used by the poll scheduler to poll active entities more often than dormant ones
+        entity_doc['last_journal_activity'] = max(new_journal_entries[0]['date'], entity_doc.get('last_journal_activity') or 0.0)
+        write_journal_entries(new_journal_entries, entity_doc)
         entity_filter = {'id': entity_doc['id']}
-        update = {"$set": entity_doc}
+        # only the journal state is written back, entity_doc was loaded when the job started
+        # and other jobs (like token_refresh) may have changed the rest of the document since
+        journal_state = {key: value for key, value in entity_doc.items() if key.startswith(journal_state_fields)}
+        update = {"$set": journal_state}
         shared.db.entities.update_one(entity_filter, update)
+    # the etag is only saved once the entries are written, so a failed update is retried in full
+    shared.save_etag(entity_doc['id'], journal_operation, first_page)
     
-def decode_journal_entry(journal_entry, entity_doc, division):
+def write_journal_entries(journal_entries, entity_doc):
+    """
+    upserts journal entries using unordered bulk writes of at most JOURNAL_WRITE_BATCH_SIZE entries each
+    raises a JournalError once a batch has been logged if any of its entries failed to write
+    """
+    for start in range(0, len(journal_entries), config.JOURNAL_WRITE_BATCH_SIZE):
+        batch = journal_entries[start:start + config.JOURNAL_WRITE_BATCH_SIZE]
+        corp_alliances = shared.find_corp_alliances(batch)
+        requests = [UpdateOne({'id': entry['id']}, shared.journal_update(entry, corp_alliances), upsert=True) for entry in batch]
+        try:
+            result = shared.db.journals.bulk_write(requests, ordered=False)
+            details = result.bulk_api_result
+        except BulkWriteError as e:
+            # unordered writes continue past errors, so the rest of the batch has still been written
+            details = e.details
+            for write_error in details['writeErrors']:
+                logger.error('error writing journal entry: ' + str(write_error['op']['q']) + ' error is: ' + write_error['errmsg'])
+        logger.debug('journal batch for ' + str(entity_doc['id']) + ': ' + str(len(batch)) + ' entries, ' +
+                     str(details['nMatched']) + ' matched, ' + str(details['nUpserted']) + ' upserted, ' +
+                     str(len(details['writeErrors'])) + ' errors')
+        shared.bump_journal_versions(batch, corp_alliances)
+        if len(details['writeErrors']) > 0:
+            # the journal high-water mark and etag must not move past entries that weren't written, so they're fetched again
+            raise JournalError()
+        
+def fetch_journal_pages(entity_doc, division, last_journal_entry, journal_operation):
+    """
+    returns the first page response and all journal entries from ESI that may be newer than last_journal_entry, newest first
+    the page count is only known after the first page, the remaining pages are then requested
+    JOURNAL_PAGE_WORKERS at a time until a page reaches back to last_journal_entry
+    """
+    # the page fetchers share this thread's client, they only read the token it holds
+    esiclient = shared.get_worker_esi()[1]
+    first_page = request_journal_page(esiclient, 1, entity_doc, division,
+                                      shared.etag_params(entity_doc['id'], journal_operation))
+    if first_page.status == 304:
+        return first_page, []
+    num_pages = int(first_page.header['X-Pages'][0])
+    pages = [first_page.data]
+    next_page = 2
+    if num_pages > 1:
+        with ThreadPoolExecutor(max_workers=config.JOURNAL_PAGE_WORKERS) as executor:
+            while next_page <= num_pages and len(pages[-1]) > 0 and pages[-1][-1]['id'] > last_journal_entry:
+                page_numbers = range(next_page, min(next_page + config.JOURNAL_PAGE_WORKERS, num_pages + 1))
+                responses = executor.map(lambda page: request_journal_page(esiclient, page, entity_doc, division), page_numbers)
+                pages.extend(response.data for response in responses)
+                next_page += len(page_numbers)
+    
+    # new entries can push an entry onto the next page while the pages are being fetched, so duplicates are dropped
+    journal_entries = {}
+    for page_data in pages:
+        for journal_entry in page_data:
+            journal_entries[journal_entry['id']] = journal_entry
+    return first_page, [journal_entries[entry_id] for entry_id in sorted(journal_entries, reverse=True)]
+
+def request_journal_page(esiclient, page, entity_doc, division, extra_params={}):
+    """ requests a single page of a character or corp division journal, raises a JournalError if ESI fails """
+    if division:
+        op = shared.esiapp.op['get_corporations_corporation_id_wallets_division_journal'](
+            corporation_id=entity_doc['id'],
+            division=division,
+            page=page,
+            **extra_params
+        )
+    else:
+        op = shared.esiapp.op['get_characters_character_id_wallet_journal'](
+            character_id=entity_doc['id'],
+            page=page,
+            **extra_params
+        )
+    journal = esiclient.request(op)
+    if journal.status != 200 and journal.status != 304:
+        logger.error('status: ' + str(journal.status) + ' error with getting journal data: ' + str(journal.data))
+        logger.error('headers: ' + str(journal.header))
+        logger.error('error with getting journal data: ' + str(entity_doc['id']))
+        raise JournalError()
+    return journal
+
+def collect_party_ids(journal_entries, last_journal_entry):
+    """ returns the ids of all characters, corps and alliances that appear in new journal entries """
+    party_ids = set()
+    for journal_entry in journal_entries:
+        if journal_entry['id'] <= last_journal_entry:
+            break
+        party_ids.add(journal_entry['first_party_id'])
+        party_ids.add(journal_entry['second_party_id'])
+        if 'tax_receiver_id' in journal_entry:
+            party_ids.add(journal_entry['tax_receiver_id'])
+        if 'context_id' in journal_entry and journal_entry['context_id_type'] in ('character_id', 'corporation_id', 'alliance_id'):
+            party_ids.add(journal_entry['context_id'])
+    return party_ids
+
+def decode_journal_entry(journal_entry, entity_doc, division, transaction_index):
     """ add embedded docs for journal entry fields """
     journal_entry['date'] = journal_entry['date'].v.replace(tzinfo=timezone.utc).timestamp()
     
@@ -310,5 +403,5 @@ def decode_journal_entry(journal_entry, entity_doc, division):
             journal_entry['tax_receiver_name'] = result['name']
             
     if 'context_id' in journal_entry:
-        context_handler.decode_context_id(journal_entry, entity_doc, division)
+        context_handler.decode_context_id(journal_entry, entity_doc, division, transaction_index)
     
\ No newline at end of file
@@ -15,7 +15,8 @@ from app.flask_shared_modules import login_manager
 from app.flask_shared_modules import mongo
 from app.flask_shared_modules import rq
 
-from jobs import wallet_refresh
+from jobs import poll_scheduler
+from jobs import token_refresh
 from jobs import public_info_refresh
 from jobs import statistics
 
@@ -45,10 +46,11 @@ for job in rq.get_scheduler().get_jobs():
 
 # Schedule all rq background jobs
 statistics.update_statistics.schedule(datetime.utcnow(), job_id="update_statistics", interval=62)
-wallet_refresh.process_character_wallets.schedule(datetime.utcnow(), job_id="process_character_wallets", interval=120)
-wallet_refresh.process_corp_wallets.schedule(datetime.utcnow(), job_id="process_corp_wallets", interval=300)
-# Public info refresh can take a long time, so it is given a timeout longer than the default
-public_info_refresh.update_all_public_info.schedule(datetime.utcnow(), job_id="update_all_public_info", interval=3600, timeout=7200)
+token_refresh.refresh_expiring_tokens.schedule(datetime.utcnow(), job_id="refresh_expiring_tokens", interval=config.TOKEN_REFRESH_INTERVAL)
+# Wallets are polled per character and corp as they become due, see jobs/poll_scheduler.py
+poll_scheduler.process_due_wallets.schedule(datetime.utcnow(), job_id="process_due_wallets", interval=config.POLL_DISPATCH_INTERVAL)
+# Public info refresh only handles the stalest PUBLIC_REFRESH_BATCH_SIZE entities per run, so it runs often with the default timeout
+public_info_refresh.update_all_public_info.schedule(datetime.utcnow(), job_id="update_all_public_info", interval=600)
 
 # create indexes in database, runs on every startup to prevent manual db setup and ensure compliance
 # if this is a production server, then we must run this with @postfork so it runs after uwsgi forks
@@ -56,7 +58,20 @@ public_info_refresh.update_all_public_info.schedule(datetime.utcnow(), job_id="u
 def ensure_db_indexes():
     with app.app_context():
         mongo.db.entities.create_index('id', unique=True)
+        mongo.db.entities.create_index([('type', pymongo.ASCENDING), ('public_refresh_attempted_at', pymongo.ASCENDING)])
+        mongo.db.entities.create_index('tokens.ExpiresOn', sparse=True)
+        mongo.db.entities.create_index('search_grams')
+        mongo.db.entities.create_index([('region_id', pymongo.ASCENDING), ('type', pymongo.ASCENDING)],
+                                       partialFilterExpression={ 'region_id': { '$exists': True } })
+        mongo.db.entities.create_index([('constellation_id', pymongo.ASCENDING), ('type', pymongo.ASCENDING)],
+                                       partialFilterExpression={ 'constellation_id': { '$exists': True } })
+        mongo.db.unresolvable_ids.create_index('id', unique=True)
+        mongo.db.unresolvable_ids.create_index('expires', expireAfterSeconds=0)
         mongo.db.journals.create_index([('id', pymongo.DESCENDING)], unique=True)
+        mongo.db.journals.create_index([('parties', pymongo.ASCENDING), ('id', pymongo.DESCENDING)], unique=True)
+        mongo.db.journals.create_index([('party_flows.id', pymongo.ASCENDING), ('party_flows.dir', pymongo.ASCENDING),
+                                        ('id', pymongo.DESCENDING)])
+        mongo.db.journals.create_index([('alliance_ids', pymongo.ASCENDING), ('id', pymongo.DESCENDING)], unique=True)
         mongo.db.journals.create_index([('first_party_id', pymongo.ASCENDING), ('id', pymongo.DESCENDING)], unique=True)
         mongo.db.journals.create_index([('second_party_id', pymongo.ASCENDING), ('id', pymongo.DESCENDING)], unique=True)
         mongo.db.journals.create_index([('tax_receiver_id', pymongo.ASCENDING), ('id', pymongo.DESCENDING)], unique=True,
@@ -1,26 +1,37 @@
 function autocomplete(inp) {
   /*the autocomplete function takes the text field element:*/
   var currentFocus;
+  /*milliseconds to wait after the last keystroke before searching, so a search isn't sent for every character typed*/
+  var debounceDelay = 250;
+  var debounceTimer;
   /*execute a function when someone writes in the text field:*/
   inp.addEventListener("input", function(e) {
-      var a, b, i, val = this.value;
+      var val = this.value;
+      clearTimeout(debounceTimer);
       /*close any already open lists of autocompleted values*/
       closeAllLists();
       if (!val) { return false;}
       if (val.length == 1) { return false;}
-      currentFocus = -1;
-      /*create a DIV element that will contain the items (values):*/
-      a = document.createElement("DIV");
-      a.setAttribute("id", this.id + "autocomplete-list");
-      a.setAttribute("class", "autocomplete-items");
-      /*append the DIV element as a child of the autocomplete container:*/
-      this.parentNode.appendChild(a);
+      debounceTimer = setTimeout(function() { search(val); }, debounceDelay);
+  });
+  function search(val) {
+      var a, b, i;
       $.ajax({
-        type: 'POST',
+        type: 'GET',
         url: inp.dataset.action,
-        data: {'search_string': inp.value },
+        data: {'q': val },
         dataType: "json"
       }).done(function( arr ) {
+        /*ignore results for a search the user has already typed past*/
+        if (inp.value != val) { return; }
+        closeAllLists();
+        currentFocus = -1;
+        /*create a DIV element that will contain the items (values):*/
+        a = document.createElement("DIV");
+        a.setAttribute("id", inp.id + "autocomplete-list");
+        a.setAttribute("class", "autocomplete-items");
+        /*append the DIV element as a child of the autocomplete container:*/
+        inp.parentNode.appendChild(a);
         if (arr.length == 0) {
           b = document.createElement("DIV");
           b.innerHTML = "<i>No Results Found</i>"
@@ -54,7 +65,7 @@ function autocomplete(inp) {
           a.appendChild(b);
         }
       });
-  });
+  }
   /*execute a function presses a key on the keyboard:*/
   inp.addEventListener("keydown", function(e) {
       var x = document.getElementById(this.id + "autocomplete-list");